@@ -1,20 +1,52 @@
+import sys
+import time
+
 import click
 from flask import Flask, current_app
 from flask.cli import with_appcontext
+from sqlalchemy import text
 from werkzeug.security import generate_password_hash
 
-from views import auth, account_change_request, reservation, user, arrangement
-
 from config.config import BaseConfig
-from config.extensions import ma, db, jwt_man, mi, mail
-from models.models import User, AccountType
+from config.extensions import ma, db, jwt_man, mi, mail, mail_queue, limiter, replicas, listener, account_types, \
+    seat_broker, hot_reads, destinations, concurrency, profiler, slow_queries
+from models.models import User, AccountType, Arrangement
+from utils.archive import archive_trips
+from utils.calendar import rebuild_calendar
+from utils.explain import explain_endpoints
+from utils.export import export_data
+from utils.guide_scheduler import schedule_guides_command
+from utils.idempotency import sweep_idempotency_keys
+from utils.listing_bench import bench_listings
+from utils.seat_holds import sweep_seat_holds
+from utils.slow_queries import slow_query_report
+from utils.startup import startup_report
+
+# flask commands which don't serve requests, they skip importing the views and the schemas
+NON_HTTP_COMMANDS = {"db", "create-extensions", "create-profile", "create-type", "startup-report",
+                     "sweep-idempotency-keys", "rebuild-calendar", "slow-query-report", "archive-trips", "export",
+                     "schedule-guides"}
+
 
+def create_app(config_object=BaseConfig):
+    # seconds spent in each phase, reported by flask startup-report
+    timings = {}
 
-def create_app(config_object=BaseConfig()):
+    started_at = time.perf_counter()
     app = Flask(__name__)
     app.config.from_object(config_object)
+    timings["config"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
     register_extensions(app)
-    register_blueprints(app)
+    timings["extensions"] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    if serves_http():
+        register_blueprints(app)
+    timings["blueprints"] = time.perf_counter() - started_at
+
+    app.extensions["startup_timings"] = timings
 
     @app.cli.command("create-profile")
     @click.option("-u", "--username", "username")
@@ -36,8 +68,7 @@ def create_app(config_object=BaseConfig()):
                 current_app.config.get("PASSWORD_SALT_LENGTH")
             )
         )
-        acc_type = AccountType.query.filter_by(name=acc_type).first()
-        admin.account_type.append(acc_type)
+        admin.account_type.append(account_types.attach_or_404(acc_type))
 
         User.query.session.add(admin)
         User.query.session.commit()
@@ -51,9 +82,30 @@ def create_app(config_object=BaseConfig()):
             name=new_type
         )
         AccountType.query.session.add(new_type)
+        account_types.changed()
         AccountType.query.session.commit()
         print(f"Successfully created type {new_type}")
 
+    @app.cli.command("create-extensions")
+    @with_appcontext
+    def create_extensions():
+        # the models need these before flask db upgrade can create their indexes (pg_trgm for the
+        # destination search), postgres-docker only creates them in a fresh database
+        db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm;'))
+        db.session.commit()
+        print("Successfully created the database extensions.")
+
+    app.cli.add_command(explain_endpoints)
+    app.cli.add_command(startup_report)
+    app.cli.add_command(sweep_idempotency_keys)
+    app.cli.add_command(rebuild_calendar)
+    app.cli.add_command(slow_query_report)
+    app.cli.add_command(archive_trips)
+    app.cli.add_command(export_data)
+    app.cli.add_command(schedule_guides_command)
+    app.cli.add_command(bench_listings)
+    app.cli.add_command(sweep_seat_holds)
+
     return app
 
 
@@ -63,11 +115,43 @@ def register_extensions(app):
     mi.init_app(app, db)
     jwt_man.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app, mail)
+    limiter.init_app(app, db)
+    replicas.init_app(app)
+    listener.init_app(app, db)
+    account_types.init_app(app, AccountType)
+    listener.subscribe(account_types.channel, account_types.invalidate)
+    seat_broker.init_app(app, Arrangement)
+    listener.subscribe(seat_broker.channel, seat_broker.publish)
+    hot_reads.init_app(app, db.session)
+    listener.subscribe(hot_reads.channel, hot_reads.invalidate)
+    destinations.init_app(app, Arrangement)
+    listener.subscribe(destinations.channel, destinations.apply)
+    concurrency.init_app(app)
+    profiler.init_app(app, account_types)
+    slow_queries.init_app(app)
+
+
+def serves_http():
+    # outside of the flask command line the app is always built to serve requests
+    if click.get_current_context(silent=True) is None:
+        return True
+
+    command = next((arg for arg in sys.argv[1:] if not arg.startswith("-")), None)
+    return command not in NON_HTTP_COMMANDS
 
 
 def register_blueprints(app):
+    from views import auth, account_change_request, reservation, user, arrangement, changes, admin
+
     app.register_blueprint(auth.auth_bp)
     app.register_blueprint(arrangement.arrangements_bp)
     app.register_blueprint(user.users_bp)
     app.register_blueprint(reservation.reservation_bp)
     app.register_blueprint(account_change_request.acc_type_change_bp)
+    app.register_blueprint(changes.changes_bp)
+    app.register_blueprint(admin.admin_bp)
+
+    # the catalogue, booking and user views each get their own adaptive concurrency limit
+    for blueprint in (auth.auth_bp, arrangement.arrangements_bp, user.users_bp, reservation.reservation_bp):
+        concurrency.protect(app, blueprint)
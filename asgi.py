@@ -0,0 +1,149 @@
+import jwt
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from config.config import BaseConfig
+from models.models import Arrangement, AccountType
+from schemas.schemas_rest import arrangement_schema, ArrangementSchema, BasicArrangementSchema, ARRANGEMENT_FIELDS, \
+    BASIC_ARRANGEMENT_FIELDS
+from utils.fieldsets import requested_fields, sparse_schema
+from utils.pagination import TOTAL_MODES, paginate, get_total, page_envelope
+from views.arrangement import catalogue_statement, AVAILABLE_ARRANGEMENTS_QUERY
+
+
+# asyncio variant of the read-only catalogue endpoints, served by an ASGI server
+# (e.g. uvicorn asgi:app) next to the flask app, so slow clients wait on the event loop
+# instead of holding a worker thread each; everything else stays in create_app
+
+
+class AuthError(Exception):
+    pass
+
+
+def get_async_database_uri(config):
+    uri = getattr(config, "ASYNC_SQLALCHEMY_DATABASE_URI", None)
+    if uri:
+        return uri
+    return config.SQLALCHEMY_DATABASE_URI.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+def get_jwt_identity(request, config, optional=False):
+    # same tokens as issued by flask_jwt_extended, the identity is the dumped user
+    authorization = request.headers.get("Authorization", "")
+    if not authorization.startswith("Bearer "):
+        if optional:
+            return None
+        raise AuthError("Missing Authorization Header")
+
+    try:
+        claims = jwt.decode(authorization[len("Bearer "):], key=config.JWT_SECRET_KEY, algorithms=["HS256"])
+    except jwt.PyJWTError as error:
+        raise AuthError(str(error))
+
+    if claims.get("type") != "access":
+        raise AuthError("Only access tokens are allowed")
+
+    return claims["sub"]
+
+
+def create_asgi_app(config_object=BaseConfig):
+    uri = get_async_database_uri(config_object)
+    connect_args = {}
+    if uri.startswith("postgresql+asyncpg://"):
+        # asyncpg prepares statements server side, the prebuilt catalogue selects render the same sql
+        # on every request so each connection keeps reusing its prepared ones
+        connect_args["prepared_statement_cache_size"] = getattr(config_object, "ASYNC_PREPARED_STATEMENT_CACHE_SIZE",
+                                                                100)
+
+    engine = create_async_engine(
+        uri,
+        pool_size=getattr(config_object, "ASYNC_POOL_SIZE", 20),
+        max_overflow=getattr(config_object, "ASYNC_MAX_OVERFLOW", 10),
+        connect_args=connect_args,
+    )
+
+    async def get_all_arrangements(request):
+        page = request.path_params["page"]
+        if page <= 0:
+            return JSONResponse({"msg": "Invalid page number."}, 400)
+
+        try:
+            detailed = get_jwt_identity(request, config_object, optional=True) is not None
+            fields = requested_fields(request.query_params,
+                                      ARRANGEMENT_FIELDS if detailed else BASIC_ARRANGEMENT_FIELDS)
+            select_statement, params = catalogue_statement(request.query_params, detailed, fields)
+        except AuthError as error:
+            return JSONResponse({"msg": str(error)}, 401)
+        except ValueError as error:
+            return JSONResponse({"msg": str(error)}, 400)
+
+        total_mode = request.query_params.get('total', None)
+        if total_mode is not None and total_mode not in TOTAL_MODES:
+            return JSONResponse({"msg": "Invalid total mode."}, 400)
+
+        schema = sparse_schema(ArrangementSchema if detailed else BasicArrangementSchema, fields, many=True)
+
+        async with engine.connect() as connection:
+            raw_arrangements, has_more = await connection.run_sync(
+                paginate, select_statement, page, config_object.RESULTS_PER_PAGE, params
+            )
+
+            total = None
+            if total_mode is not None:
+                total = await connection.run_sync(
+                    get_total, total_mode, select_statement, config_object.COUNT_CACHE_TTL, params
+                )
+
+        return JSONResponse(page_envelope(schema.dump(raw_arrangements), page, has_more, total))
+
+    async def get_arrangement(request):
+        try:
+            get_jwt_identity(request, config_object)
+        except AuthError as error:
+            return JSONResponse({"msg": str(error)}, 401)
+
+        async with engine.connect() as connection:
+            arrangement = (await connection.execute(
+                select(*Arrangement.__table__.columns, Arrangement.seats_available)
+                    .where(Arrangement.id == request.path_params["arrangement_id"])
+            )).first()
+
+        if arrangement is None:
+            return JSONResponse({"msg": "No such arrangement found."}, 404)
+
+        return JSONResponse(arrangement_schema.dump(arrangement))
+
+    async def get_available_arrangements(request):
+        try:
+            identity = get_jwt_identity(request, config_object)
+        except AuthError as error:
+            return JSONResponse({"msg": str(error)}, 401)
+
+        async with engine.connect() as connection:
+            account_type = (await connection.execute(
+                select(AccountType.name).where(AccountType.id == identity["account_type"][0])
+            )).scalar()
+
+            if account_type != "TOURIST":
+                return JSONResponse({"msg": "Forbidden method."}, 403)
+
+            available_arrangements = (await connection.execute(
+                AVAILABLE_ARRANGEMENTS_QUERY, {"curr_user_id": identity["id"]}
+            )).all()
+
+        return JSONResponse([arrangement_schema.dump(arrangement) for arrangement in available_arrangements])
+
+    return Starlette(
+        routes=[
+            Route('/arrangements/page/{page:int}', get_all_arrangements),
+            Route('/arrangements/available', get_available_arrangements),
+            Route('/arrangements/{arrangement_id:int}', get_arrangement),
+        ],
+        on_shutdown=[engine.dispose],
+    )
+
+
+app = create_asgi_app()
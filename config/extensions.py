@@ -2,10 +2,32 @@ from flask_jwt_extended import JWTManager
 from flask_mail import Mail
 from flask_marshmallow import Marshmallow
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+from utils.account_types import AccountTypeRegistry
+from utils.concurrency import ConcurrencyLimiter
+from utils.destination_index import DestinationIndex
+from utils.mail_queue import MailQueue
+from utils.pg_listener import PgListener
+from utils.profiler import RequestProfiler
+from utils.rate_limiter import RateLimiter
+from utils.replica import RoutingSQLAlchemy, ReplicaRouter
+from utils.seat_broker import SeatBroker
+from utils.single_flight import SingleFlight
+from utils.slow_queries import SlowQueryLog
+
+db = RoutingSQLAlchemy()
 ma = Marshmallow()
 mi = Migrate()
 jwt_man = JWTManager()
 mail = Mail()
+mail_queue = MailQueue()
+limiter = RateLimiter()
+replicas = ReplicaRouter()
+listener = PgListener()
+account_types = AccountTypeRegistry()
+seat_broker = SeatBroker()
+hot_reads = SingleFlight()
+destinations = DestinationIndex()
+concurrency = ConcurrencyLimiter()
+profiler = RequestProfiler()
+slow_queries = SlowQueryLog()
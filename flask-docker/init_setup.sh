@@ -1,4 +1,7 @@
 
+# databases created before an extension was needed get it ahead of their next upgrade
+flask create-extensions
+
 # first time configuration
 if [ ! -d migrations ]; then
   flask db init &&
@@ -1,16 +1,19 @@
+import datetime
 from time import time
 
 import jwt
 import marshmallow
 from flask import current_app
-from sqlalchemy import CheckConstraint, select, and_
+from sqlalchemy import CheckConstraint, select, and_, func, text, case, bindparam
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 
-from config.extensions import db
+from config.extensions import db, account_types
 
 user_type_table = db.Table('user_type', db.metadata,
                            db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-                           db.Column('account_type_id', db.Integer, db.ForeignKey('account_type.id'), primary_key=True)
+                           db.Column('account_type_id', db.Integer, db.ForeignKey('account_type.id'), primary_key=True),
+                           # the primary key only covers lookups by user, this one covers the users by type filter
+                           db.Index('ix_user_type_account_type_id', 'account_type_id', 'user_id')
                            )
 
 
@@ -96,17 +99,43 @@ class Arrangement(db.Model):
     cancelled = db.Column(db.Boolean, default=False)
     number_of_seats = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
-    guide_id = db.Column(db.ForeignKey('user.id'), nullable=True)
-    creator_id = db.Column(db.ForeignKey('user.id'), nullable=False)
+    guide_id = db.Column(db.ForeignKey('user.id'), nullable=True, index=True)
+    creator_id = db.Column(db.ForeignKey('user.id'), nullable=False, index=True)
     reservations = db.relationship('Reservation', backref='arrangements_id')
+    holds = db.relationship('SeatHold', backref='arrangement', cascade='all, delete-orphan')
 
     __table_args__ = (CheckConstraint(start_date < end_date, name='check_dates_correct'),
                       CheckConstraint(price > 0, name='check_price_positive'),
-                      CheckConstraint(number_of_seats > 0, name='check_seats_number_positive'))
+                      CheckConstraint(number_of_seats > 0, name='check_seats_number_positive'),
+                      # default catalogue order and the start/end date range filter
+                      db.Index('ix_arrangement_start_date_end_date', 'start_date', 'end_date'),
+                      db.Index('ix_arrangement_end_date', 'end_date'),
+                      db.Index('ix_arrangement_price', 'price'),
+                      db.Index('ix_arrangement_number_of_seats', 'number_of_seats'),
+                      db.Index('ix_arrangement_destination', 'destination'),
+                      # the catalogue destination filter is a LIKE '%...%', only a trigram index can serve it
+                      db.Index('ix_arrangement_destination_trgm', 'destination',
+                               postgresql_using='gin', postgresql_ops={'destination': 'gin_trgm_ops'}))
 
     @hybrid_property
     def seats_available(self):
-        return self.number_of_seats - sum(reservation.seats_needed for reservation in self.reservations)
+        now = datetime.datetime.now()
+        return self.number_of_seats \
+            - sum(reservation.seats_needed for reservation in self.reservations) \
+            - sum(hold.seats_needed for hold in self.holds if hold.expires_at > now)
+
+    @seats_available.expression
+    def seats_available(cls):
+        # lets the seats be computed in the same statement, without loading the reservations
+        reserved_seats = select(func.coalesce(func.sum(Reservation.seats_needed), 0)) \
+            .where(Reservation.arrangement_id == cls.id) \
+            .scalar_subquery()
+        # expired holds stop counting right away, flask sweep-seat-holds deletes them later
+        held_seats = select(func.coalesce(func.sum(SeatHold.seats_needed), 0)) \
+            .where(SeatHold.arrangement_id == cls.id,
+                   SeatHold.expires_at > bindparam("now", callable_=datetime.datetime.now, unique=True)) \
+            .scalar_subquery()
+        return (cls.number_of_seats - reserved_seats - held_seats).label('seats_available')
 
     def update(self, other):
         if not self.cancelled:
@@ -122,12 +151,22 @@ class Arrangement(db.Model):
             raise marshmallow.ValidationError(message='Arrangement is cancelled, therefore it cannot be changed.')
 
 
+def reservation_price_expression(seats_needed, price):
+    # Reservation.reservation_price in sql: the first three seats at full price, the rest at 90%
+    return case(
+        (seats_needed < 3, seats_needed * price),
+        else_=3 * price + 0.9 * price * (seats_needed - 3)
+    )
+
+
 class Reservation(db.Model):
     seats_needed = db.Column(db.Integer, nullable=False)
     customer_id = db.Column(db.ForeignKey('user.id'), nullable=False, primary_key=True)
     arrangement_id = db.Column(db.ForeignKey('arrangement.id'), nullable=False, primary_key=True)
 
-    __table_args__ = (CheckConstraint(seats_needed >= 0, name='check_seats_positive'),)
+    __table_args__ = (CheckConstraint(seats_needed >= 0, name='check_seats_positive'),
+                      # customer_id is the second column of the primary key, so it can't serve lookups by customer
+                      db.Index('ix_reservation_customer_id', 'customer_id'))
 
     @hybrid_property
     def reservation_price(self):
@@ -140,6 +179,11 @@ class Reservation(db.Model):
 
         return result
 
+    @reservation_price.expression
+    def reservation_price(cls):
+        price = select(Arrangement.price).where(Arrangement.id == cls.arrangement_id).scalar_subquery()
+        return reservation_price_expression(cls.seats_needed, price).label('reservation_price')
+
     @hybrid_property
     def customer_details(self):
         user = User.query.filter_by(id=self.customer_id).first()
@@ -147,22 +191,116 @@ class Reservation(db.Model):
         return user
 
 
+class SeatHold(db.Model):
+    # seats put aside for a tourist during checkout, until confirmed into a reservation or expired
+    id = db.Column(db.Integer, primary_key=True)
+    seats_needed = db.Column(db.Integer, nullable=False)
+    customer_id = db.Column(db.ForeignKey('user.id'), nullable=False)
+    arrangement_id = db.Column(db.ForeignKey('arrangement.id', ondelete='CASCADE'), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (CheckConstraint(seats_needed > 0, name='check_held_seats_positive'),
+                      # one hold per customer and arrangement, like the reservation it turns into
+                      db.UniqueConstraint('arrangement_id', 'customer_id', name='uq_seat_hold_arrangement_customer'),
+                      # the held seats of an arrangement are summed over its unexpired holds
+                      db.Index('ix_seat_hold_arrangement_id_expires_at', 'arrangement_id', 'expires_at'),
+                      db.Index('ix_seat_hold_customer_id', 'customer_id'))
+
+
+class WaitlistEntry(db.Model):
+    # tourists waiting for seats on a sold out arrangement, the freed seats are offered in id order
+    id = db.Column(db.Integer, primary_key=True)
+    seats_needed = db.Column(db.Integer, nullable=False)
+    customer_id = db.Column(db.ForeignKey('user.id'), nullable=False)
+    arrangement_id = db.Column(db.ForeignKey('arrangement.id', ondelete='CASCADE'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (CheckConstraint(seats_needed > 0, name='check_waitlisted_seats_positive'),
+                      db.UniqueConstraint('arrangement_id', 'customer_id',
+                                          name='uq_waitlist_entry_arrangement_customer'),
+                      # the queue of an arrangement, promotion reads its head without scanning the rest
+                      db.Index('ix_waitlist_entry_arrangement_id_id', 'arrangement_id', 'id'),
+                      db.Index('ix_waitlist_entry_customer_id', 'customer_id'))
+
+
 class AccountTypeChangeRequest(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.ForeignKey('user.id'), nullable=False, index=True)
     wanted_type_id = db.Column(db.ForeignKey('account_type.id'), nullable=False)
-    filing_date = db.Column(db.DateTime, nullable=False)
-    confirmation_date = db.Column(db.DateTime, nullable=True)
+    filing_date = db.Column(db.DateTime, nullable=False, index=True)
+    confirmation_date = db.Column(db.DateTime, nullable=True, index=True)
     admin_confirmed_id = db.Column(db.ForeignKey('user.id'), nullable=True)
     granted = db.Column(db.Boolean, nullable=True)
     comment = db.Column(db.Text, nullable=True)
 
     @hybrid_property
     def wanted_type(self):
-        acc_type = AccountType.query.filter_by(id=self.wanted_type_id).first()
-        return acc_type.name
+        return account_types.name_of(self.wanted_type_id)
 
     def update(self, other):
         self.confirmation_date = other.confirmation_date
         self.admin_confirmed_id = other.admin_confirmed_id
         self.comment = other.comment
+
+
+class RateLimitBucket(db.Model):
+    key = db.Column(db.String(256), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)
+    allowed = db.Column(db.Boolean, nullable=False, default=True)
+
+
+class IdempotencyKey(db.Model):
+    # scoped to the user and the endpoint, see utils/idempotency.py
+    key = db.Column(db.String(256), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    # status and body stay empty while the first request is being handled
+    status_code = db.Column(db.Integer, nullable=True)
+    response_body = db.Column(db.LargeBinary, nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ArrangementDayBucket(db.Model):
+    # arrangements departing on a day, kept up to date by the arrangement and reservation writes
+    day = db.Column(db.Date, primary_key=True)
+    destination = db.Column(db.Text, primary_key=True)
+    departures = db.Column(db.Integer, nullable=False, default=0)
+    free_seats = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ChangeLogEntry(db.Model):
+    id = db.Column(db.BigInteger, primary_key=True)
+    # the cursor is (transaction_id, id), see utils/change_feed.py
+    transaction_id = db.Column(db.BigInteger, nullable=False, server_default=text('txid_current()'))
+    entity = db.Column(db.String(32), nullable=False)
+    entity_id = db.Column(db.String(64), nullable=False)
+    operation = db.Column(db.String(16), nullable=False)
+    data = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (db.Index('ix_change_log_entry_cursor', 'transaction_id', 'id'),)
+
+
+class ArchivedArrangement(db.Model):
+    # finished arrangements moved out of arrangement by flask archive-trips, same ids and columns
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    start_date = db.Column(db.Date, nullable=False, index=True)
+    end_date = db.Column(db.Date, nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    destination = db.Column(db.Text, nullable=False)
+    cancelled = db.Column(db.Boolean, default=False)
+    number_of_seats = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    guide_id = db.Column(db.ForeignKey('user.id'), nullable=True, index=True)
+    creator_id = db.Column(db.ForeignKey('user.id'), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+    reservations = db.relationship('ArchivedReservation', lazy='select')
+
+
+class ArchivedReservation(db.Model):
+    seats_needed = db.Column(db.Integer, nullable=False)
+    customer_id = db.Column(db.ForeignKey('user.id'), nullable=False, primary_key=True)
+    arrangement_id = db.Column(db.ForeignKey('archived_arrangement.id'), nullable=False, primary_key=True)
+
+    __table_args__ = (db.Index('ix_archived_reservation_customer_id', 'customer_id'),)
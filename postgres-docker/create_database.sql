@@ -1 +1,5 @@
 CREATE DATABASE tourist_api_db;
+
+\c tourist_api_db
+-- trigram indexes back the LIKE '%...%' destination search
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
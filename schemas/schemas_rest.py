@@ -5,8 +5,9 @@ from flask import request
 from marshmallow import validate, validates, post_load
 from marshmallow_sqlalchemy import fields
 
-from config.extensions import ma
-from models.models import Reservation, AccountType, Arrangement, AccountTypeChangeRequest, User
+from config.extensions import ma, account_types
+from models.models import Reservation, AccountType, Arrangement, AccountTypeChangeRequest, User, ArchivedArrangement, \
+    ArchivedReservation, SeatHold, WaitlistEntry
 
 
 class AccountTypeSchema(ma.SQLAlchemyAutoSchema):
@@ -42,9 +43,8 @@ class UserSchema(ma.SQLAlchemyAutoSchema):
         self.id = data["id"]
         self.username = data["username"]
         self.email = data["email"]
-        account_type = AccountType.query.filter_by(id=data["account_type"][0]) \
-            .first_or_404(description='Invalid account type')
-        self.account_type = account_type
+        self.account_type = account_types.get_or_404(type_id=data["account_type"][0],
+                                                     description='Invalid account type')
 
         return self
 
@@ -62,6 +62,14 @@ class UserSchema(ma.SQLAlchemyAutoSchema):
 
 user_schema = UserSchema()
 users_schema = UserSchema(many=True)
+# fields=... may pick from these, each mapped to the column loading it
+USER_FIELDS = {
+    "id": User.id,
+    "username": User.username,
+    "email": User.email,
+    "first_name": User.first_name,
+    "last_name": User.last_name,
+}
 
 
 class ArrangementSchema(ma.SQLAlchemyAutoSchema):
@@ -112,6 +120,19 @@ class ArrangementSchema(ma.SQLAlchemyAutoSchema):
 
 arrangement_schema = ArrangementSchema()
 arrangements_schema = ArrangementSchema(many=True)
+ARRANGEMENT_FIELDS = {
+    "id": Arrangement.id,
+    "start_date": Arrangement.start_date,
+    "end_date": Arrangement.end_date,
+    "description": Arrangement.description,
+    "destination": Arrangement.destination,
+    "cancelled": Arrangement.cancelled,
+    "number_of_seats": Arrangement.number_of_seats,
+    "price": Arrangement.price,
+    "guide_id": Arrangement.guide_id,
+    "creator_id": Arrangement.creator_id,
+    "seats_available": Arrangement.seats_available,
+}
 
 
 class BasicArrangementSchema(ma.SQLAlchemySchema):
@@ -127,6 +148,12 @@ class BasicArrangementSchema(ma.SQLAlchemySchema):
 
 basic_arrangement_schema = BasicArrangementSchema()
 basic_arrangements_schema = BasicArrangementSchema(many=True)
+BASIC_ARRANGEMENT_FIELDS = {
+    "id": Arrangement.id,
+    "start_date": Arrangement.start_date,
+    "destination": Arrangement.destination,
+    "price": Arrangement.price,
+}
 
 
 class GuideArrangementSchema(UserSchema):
@@ -153,6 +180,12 @@ class ReservationSchema(ma.SQLAlchemyAutoSchema):
 
 reservation_schema = ReservationSchema()
 reservations_schema = ReservationSchema(many=True)
+RESERVATION_FIELDS = {
+    "arrangement_id": Reservation.arrangement_id,
+    "customer_id": Reservation.customer_id,
+    "seats_needed": Reservation.seats_needed,
+    "reservation_price": Reservation.reservation_price,
+}
 
 
 class CompletedReservationSchema(ReservationSchema):
@@ -169,6 +202,45 @@ class TouristReservationSchema(UserSchema):
 tourist_reservation_schema = TouristReservationSchema()
 
 
+class SeatHoldSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = SeatHold
+        load_instance = True
+
+    id = ma.auto_field(dump_only=True)
+    customer_id = ma.auto_field(dump_only=True)
+    arrangement_id = ma.auto_field(required=True)
+    expires_at = ma.auto_field(dump_only=True)
+
+    @validates('seats_needed')
+    def validate_seats_needed(self, value):
+        if value <= 0:
+            raise validate.ValidationError('Seats needed must not be 0.')
+
+
+seat_hold_schema = SeatHoldSchema()
+
+
+class WaitlistEntrySchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = WaitlistEntry
+        load_instance = True
+
+    id = ma.auto_field(dump_only=True)
+    customer_id = ma.auto_field(dump_only=True)
+    arrangement_id = ma.auto_field(required=True)
+    created_at = ma.auto_field(dump_only=True)
+
+    @validates('seats_needed')
+    def validate_seats_needed(self, value):
+        if value <= 0:
+            raise validate.ValidationError('Seats needed must not be 0.')
+
+
+waitlist_entry_schema = WaitlistEntrySchema()
+waitlist_entries_schema = WaitlistEntrySchema(many=True)
+
+
 class AccountTypeChangeRequestSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = AccountTypeChangeRequest
@@ -199,3 +271,25 @@ class BaseAccountTypeChangeRequestSchema(AccountTypeChangeRequestSchema):
 
 base_account_type_change_request_schema = BaseAccountTypeChangeRequestSchema()
 base_account_type_change_requests_schema = BaseAccountTypeChangeRequestSchema(many=True)
+
+
+class ArchivedReservationSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = ArchivedReservation
+        include_fk = True
+
+
+class ArchivedArrangementSchema(ma.SQLAlchemyAutoSchema):
+    class Meta:
+        model = ArchivedArrangement
+        include_fk = True
+
+
+archived_arrangements_schema = ArchivedArrangementSchema(many=True)
+
+
+class CompletedArchivedArrangementSchema(ArchivedArrangementSchema):
+    reservations = fields.fields.List(fields.Nested(ArchivedReservationSchema))
+
+
+completed_archived_arrangement_schema = CompletedArchivedArrangementSchema()
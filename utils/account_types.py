@@ -0,0 +1,70 @@
+from flask import abort
+from sqlalchemy import select
+from sqlalchemy.orm import make_transient_to_detached
+
+from utils.pg_listener import PgListener
+
+
+class AccountTypeRegistry(object):
+    """Process-local name <-> id map of the account types.
+
+    Loaded when the app starts serving and reloaded lazily after an invalidation, which every
+    worker gets through the account_types_changed notification whenever a type is written.
+    """
+
+    channel = "account_types_changed"
+
+    def __init__(self, app=None, model=None):
+        self.types = None
+        if app is not None:
+            self.init_app(app, model)
+
+    def init_app(self, app, model):
+        self.model = model
+        app.before_first_request(self.load)
+
+    def load(self):
+        rows = self.model.query.session.execute(select(self.model.id, self.model.name)).all()
+
+        # swapped in one assignment so readers never see a half built registry
+        self.types = ({name: type_id for type_id, name in rows}, {type_id: name for type_id, name in rows})
+        return self.types
+
+    def invalidate(self, payload=None):
+        self.types = None
+
+    def changed(self):
+        # called inside the transaction writing the type, the other workers are told once it commits
+        PgListener.notify(self.model.query.session, self.channel)
+        self.invalidate()
+
+    def _get_types(self):
+        types = self.types
+        if types is None:
+            types = self.load()
+        return types
+
+    def id_of(self, name):
+        return self._get_types()[0].get(name)
+
+    def name_of(self, type_id):
+        return self._get_types()[1].get(type_id)
+
+    def get_or_404(self, name=None, type_id=None, description="No such account type found."):
+        """Returns the account type as a detached instance, without querying it."""
+        if type_id is None:
+            type_id = self.id_of(name)
+        else:
+            name = self.name_of(type_id)
+
+        if type_id is None or name is None:
+            abort(404, description=description)
+
+        acc_type = self.model(id=type_id, name=name)
+        make_transient_to_detached(acc_type)
+        return acc_type
+
+    def attach_or_404(self, name, description="No such account type found."):
+        """Returns the account type attached to the current session, e.g. to be appended to a user."""
+        acc_type = self.get_or_404(name=name, description=description)
+        return self.model.query.session.merge(acc_type, load=False)
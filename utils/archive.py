@@ -0,0 +1,111 @@
+import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, insert, delete, literal, cast, String
+
+from config.extensions import db
+from models.models import Arrangement, Reservation, ArchivedArrangement, ArchivedReservation, ChangeLogEntry, \
+    SeatHold, WaitlistEntry
+
+ARRANGEMENT_COLUMNS = [column.name for column in Arrangement.__table__.columns]
+RESERVATION_COLUMNS = [column.name for column in Reservation.__table__.columns]
+
+
+def record_archived(arrangement_ids):
+    # archived trips leave the live tables, so change feed readers see them as deleted
+    db.session.execute(insert(ChangeLogEntry).from_select(
+        ["entity", "entity_id", "operation"],
+        select(literal("arrangement"), cast(Arrangement.id, String), literal("delete"))
+            .where(Arrangement.id.in_(arrangement_ids))
+    ))
+    db.session.execute(insert(ChangeLogEntry).from_select(
+        ["entity", "entity_id", "operation"],
+        select(
+            literal("reservation"),
+            cast(Reservation.arrangement_id, String) + ":" + cast(Reservation.customer_id, String),
+            literal("delete")
+        ).where(Reservation.arrangement_id.in_(arrangement_ids))
+    ))
+
+
+def archive_batch(cutoff, batch_size):
+    """Moves up to batch_size arrangements which ended before the cutoff, with their reservations.
+
+    Returns the number of arrangements and reservations moved, the whole batch commits at once.
+    """
+    # arrangements being written right now are left for the next run instead of waited for
+    arrangement_ids = db.session.execute(
+        select(Arrangement.id)
+            .where(Arrangement.end_date < cutoff)
+            .order_by(Arrangement.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+    ).scalars().all()
+
+    if not arrangement_ids:
+        db.session.rollback()
+        return 0, 0
+
+    db.session.execute(insert(ArchivedArrangement).from_select(
+        ARRANGEMENT_COLUMNS,
+        select(*Arrangement.__table__.columns).where(Arrangement.id.in_(arrangement_ids))
+    ))
+    record_archived(arrangement_ids)
+
+    moved_reservations = delete(Reservation) \
+        .where(Reservation.arrangement_id.in_(arrangement_ids)) \
+        .returning(*Reservation.__table__.columns) \
+        .cte("moved_reservations")
+    reservations = db.session.execute(
+        insert(ArchivedReservation).from_select(RESERVATION_COLUMNS, select(moved_reservations))
+    ).rowcount
+
+    # holds and waitlists left on a finished trip are worthless, the sweeper may not have got to the holds yet
+    db.session.execute(
+        delete(SeatHold)
+            .where(SeatHold.arrangement_id.in_(arrangement_ids))
+            .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        delete(WaitlistEntry)
+            .where(WaitlistEntry.arrangement_id.in_(arrangement_ids))
+            .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        delete(Arrangement)
+            .where(Arrangement.id.in_(arrangement_ids))
+            .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    return len(arrangement_ids), reservations
+
+
+@click.command("archive-trips")
+@click.option("-d", "--days", "days", type=int, default=None,
+              help="Archive arrangements which ended more than this many days ago.")
+@click.option("-b", "--batch-size", "batch_size", type=int, default=None, help="Arrangements moved per transaction.")
+@click.option("-m", "--max-batches", "max_batches", type=int, default=None, help="Stop after this many batches.")
+@with_appcontext
+def archive_trips(days, batch_size, max_batches):
+    """Moves finished arrangements and their reservations to the archive tables."""
+    if days is None:
+        days = current_app.config.get("ARCHIVE_AFTER_DAYS")
+    if batch_size is None:
+        batch_size = current_app.config.get("ARCHIVE_BATCH_SIZE")
+
+    cutoff = datetime.date.today() - datetime.timedelta(days=days)
+    arrangements = reservations = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        moved_arrangements, moved_reservations = archive_batch(cutoff, batch_size)
+        if not moved_arrangements:
+            break
+
+        arrangements += moved_arrangements
+        reservations += moved_reservations
+        batches += 1
+
+    print(f"Archived {arrangements} arrangements and {reservations} reservations ending before {cutoff}.")
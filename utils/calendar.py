@@ -0,0 +1,80 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from config.extensions import db
+from models.models import ArrangementDayBucket
+
+# the calendar counts a hold's seats until the hold is deleted, expired or not: the writes take them out
+# when the hold is made and only flask sweep-seat-holds gives them back, so the rebuild does the same
+REBUILD_QUERY = text(
+    'INSERT INTO arrangement_day_bucket (day, destination, departures, free_seats) '
+    'SELECT '
+        'arrangement.start_date, '
+        'arrangement.destination, '
+        'COUNT(*), '
+        'SUM(arrangement.number_of_seats - COALESCE(reserved.seats, 0) - COALESCE(held.seats, 0)) '
+    'FROM arrangement '
+    'LEFT JOIN ('
+        'SELECT arrangement_id, SUM(seats_needed) AS seats FROM reservation GROUP BY arrangement_id'
+    ') AS reserved ON reserved.arrangement_id = arrangement.id '
+    'LEFT JOIN ('
+        'SELECT arrangement_id, SUM(seats_needed) AS seats FROM seat_hold GROUP BY arrangement_id'
+    ') AS held ON held.arrangement_id = arrangement.id '
+    'WHERE arrangement.cancelled IS NOT TRUE '
+    'GROUP BY arrangement.start_date, arrangement.destination;'
+)
+
+
+def update_day_bucket(day, destination, departures, free_seats):
+    statement = insert(ArrangementDayBucket).values(
+        day=day,
+        destination=destination,
+        departures=departures,
+        free_seats=free_seats
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[ArrangementDayBucket.day, ArrangementDayBucket.destination],
+        set_={
+            "departures": ArrangementDayBucket.departures + statement.excluded.departures,
+            "free_seats": ArrangementDayBucket.free_seats + statement.excluded.free_seats,
+        }
+    )
+    db.session.execute(statement)
+
+
+def tracked_seats(arrangement):
+    # the arrangement's free seats as the calendar counts them, unlike seats_available with the expired holds
+    return arrangement.number_of_seats \
+        - sum(reservation.seats_needed for reservation in arrangement.reservations) \
+        - sum(hold.seats_needed for hold in arrangement.holds)
+
+
+def track_arrangement(arrangement, sign=1):
+    # counts the arrangement into its departure day, or out of it with sign=-1
+    # (before an update takes the old values out, after it puts the new ones in)
+    if arrangement.cancelled:
+        return
+
+    update_day_bucket(arrangement.start_date, arrangement.destination, sign, sign * tracked_seats(arrangement))
+
+
+def track_seats(arrangement, seats):
+    # seats freed (positive) or taken (negative) on the arrangement
+    if arrangement.cancelled or seats == 0:
+        return
+
+    update_day_bucket(arrangement.start_date, arrangement.destination, 0, seats)
+
+
+@click.command("rebuild-calendar")
+@with_appcontext
+def rebuild_calendar():
+    """Recomputes the availability calendar from the arrangements, reservations and seat holds."""
+    db.session.execute(text('LOCK TABLE arrangement_day_bucket;'))
+    db.session.execute(text('DELETE FROM arrangement_day_bucket;'))
+    db.session.execute(REBUILD_QUERY)
+    db.session.commit()
+
+    print("Successfully rebuilt the availability calendar.")
@@ -0,0 +1,84 @@
+from sqlalchemy import select, func, tuple_
+
+from config.extensions import db
+from models.models import ChangeLogEntry
+
+# the id alone can't be the cursor: ids are taken at insert time but become visible at commit
+# time, so a reader could move past an id whose transaction hasn't committed yet;
+# every transaction older than the snapshot's xmin has either committed or aborted, so ordering
+# by (transaction, id) and only reading those transactions never skips anything
+VISIBLE_TRANSACTIONS = ChangeLogEntry.transaction_id < func.txid_snapshot_xmin(func.txid_current_snapshot())
+
+# what anonymous readers see of an arrangement, as in BasicArrangementSchema; the id is the entry's own
+BASIC_ARRANGEMENT_FIELDS = ("start_date", "destination", "price")
+
+
+def arrangement_data(arrangement):
+    return {
+        "start_date": arrangement.start_date.isoformat(),
+        "end_date": arrangement.end_date.isoformat(),
+        "description": arrangement.description,
+        "destination": arrangement.destination,
+        "number_of_seats": arrangement.number_of_seats,
+        "price": arrangement.price,
+        "guide_id": arrangement.guide_id,
+        "cancelled": bool(arrangement.cancelled),
+    }
+
+
+def record_change(entity, entity_id, operation, data=None):
+    # added to the writer's session, so the entry commits (or rolls back) with the change itself
+    db.session.add(ChangeLogEntry(entity=entity, entity_id=str(entity_id), operation=operation, data=data))
+
+
+def record_arrangement_change(arrangement, operation):
+    record_change("arrangement", arrangement.id, operation,
+                  arrangement_data(arrangement) if operation != "delete" else None)
+
+
+def record_reservation_change(reservation, operation):
+    record_change("reservation", f"{reservation.arrangement_id}:{reservation.customer_id}", operation,
+                  {"seats_needed": reservation.seats_needed} if operation != "delete" else None)
+
+
+def parse_cursor(cursor):
+    transaction_id, entry_id = cursor.split("-")
+    return int(transaction_id), int(entry_id)
+
+
+def format_cursor(entry):
+    return f"{entry.transaction_id}-{entry.id}"
+
+
+def entry_data(entry, detailed):
+    if detailed or entry.data is None or entry.entity != "arrangement":
+        return entry.data
+    return {field: entry.data[field] for field in BASIC_ARRANGEMENT_FIELDS if field in entry.data}
+
+
+def read_changes(cursor, limit, entities, detailed=True):
+    """Returns the changes after the cursor and the cursor to resume from, raises ValueError on a bad cursor.
+
+    Without detailed, arrangement changes only carry the basic fields.
+    """
+    transaction_id, entry_id = parse_cursor(cursor)
+
+    entries = db.session.execute(
+        select(ChangeLogEntry)
+            .where(
+                tuple_(ChangeLogEntry.transaction_id, ChangeLogEntry.id) > tuple_(transaction_id, entry_id),
+                VISIBLE_TRANSACTIONS,
+                ChangeLogEntry.entity.in_(entities)
+            )
+            .order_by(ChangeLogEntry.transaction_id.asc(), ChangeLogEntry.id.asc())
+            .limit(limit + 1)
+    ).scalars().all()
+
+    page = entries[:limit]
+    changes = [
+        {"entity": entry.entity, "id": entry.entity_id, "op": entry.operation, "data": entry_data(entry, detailed)}
+        for entry in page
+    ]
+    next_cursor = format_cursor(page[-1]) if page else cursor
+
+    return changes, next_cursor, len(entries) > limit
@@ -0,0 +1,150 @@
+import threading
+import time
+
+from flask import current_app, g, request
+
+# share of a blueprint's concurrency limit each priority class may fill, so when the
+# database slows down anonymous browsing is shed first and bookings and logins last
+PRIORITY_SHARES = {
+    "critical": 1.0,
+    "normal": 0.8,
+    "low": 0.5,
+}
+
+
+def priority(level):
+    """Puts a view into a priority class, by default logged in requests are normal and anonymous ones low."""
+    def wrapper(fn):
+        fn.priority = level
+        return fn
+
+    return wrapper
+
+
+class AdaptiveLimit(object):
+    # additive increase, multiplicative decrease: the limit grows by one per limit's worth of
+    # requests answered within the target latency and shrinks by the backoff factor (at most once
+    # per target latency) when they are slower
+    def __init__(self, initial, min_limit, max_limit, target_latency, backoff, queue_sizes, queue_timeout):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.queue_sizes = queue_sizes
+        self.queue_timeout = queue_timeout
+
+        self.in_flight = 0
+        self.waiting = {level: 0 for level in PRIORITY_SHARES}
+        self.rejected = {level: 0 for level in PRIORITY_SHARES}
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def _has_room(self, level):
+        return self.in_flight < max(1, int(self.limit * PRIORITY_SHARES[level]))
+
+    def acquire(self, level):
+        with self.condition:
+            if self._has_room(level):
+                self.in_flight += 1
+                return True
+
+            if self.waiting[level] >= self.queue_sizes[level]:
+                self.rejected[level] += 1
+                return False
+
+            self.waiting[level] += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while not self._has_room(level):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected[level] += 1
+                        return False
+                    self.condition.wait(remaining)
+
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting[level] -= 1
+
+    def release(self, latency):
+        with self.condition:
+            self.in_flight -= 1
+
+            now = time.monotonic()
+            if latency > self.target_latency:
+                if now - self.last_decrease > self.target_latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "waiting": dict(self.waiting),
+                "rejected": dict(self.rejected),
+            }
+
+
+class ConcurrencyLimiter(object):
+    def __init__(self, app=None):
+        self.limits = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CONCURRENCY_LIMIT_ENABLED", True)
+        app.config.setdefault("CONCURRENCY_INITIAL_LIMIT", 20)
+        app.config.setdefault("CONCURRENCY_MIN_LIMIT", 2)
+        app.config.setdefault("CONCURRENCY_MAX_LIMIT", 200)
+        app.config.setdefault("CONCURRENCY_TARGET_LATENCY", 0.25)
+        app.config.setdefault("CONCURRENCY_BACKOFF", 0.9)
+        app.config.setdefault("CONCURRENCY_QUEUE_SIZES", {"critical": 50, "normal": 20, "low": 5})
+        app.config.setdefault("CONCURRENCY_QUEUE_TIMEOUT", 2)
+
+    def protect(self, app, blueprint):
+        """Puts every request of the (already registered) blueprint behind its own adaptive limit."""
+        if not app.config["CONCURRENCY_LIMIT_ENABLED"]:
+            return
+
+        self.limits[blueprint.name] = AdaptiveLimit(
+            app.config["CONCURRENCY_INITIAL_LIMIT"],
+            app.config["CONCURRENCY_MIN_LIMIT"],
+            app.config["CONCURRENCY_MAX_LIMIT"],
+            app.config["CONCURRENCY_TARGET_LATENCY"],
+            app.config["CONCURRENCY_BACKOFF"],
+            app.config["CONCURRENCY_QUEUE_SIZES"],
+            app.config["CONCURRENCY_QUEUE_TIMEOUT"],
+        )
+
+        app.before_request_funcs.setdefault(blueprint.name, []).append(
+            lambda: self.before_request(blueprint.name)
+        )
+        app.teardown_request_funcs.setdefault(blueprint.name, []).append(self.teardown_request)
+
+    def before_request(self, name):
+        view = current_app.view_functions.get(request.endpoint)
+        level = getattr(view, "priority", None)
+        if level is None:
+            level = "normal" if "Authorization" in request.headers else "low"
+
+        if not self.limits[name].acquire(level):
+            return {"msg": "Server is busy, try again later."}, 503, {"Retry-After": "1"}
+
+        g.concurrency_slot = (self.limits[name], time.monotonic())
+
+    @staticmethod
+    def teardown_request(exception=None):
+        slot = g.pop("concurrency_slot", None)
+        if slot is not None:
+            limit, started_at = slot
+            limit.release(time.monotonic() - started_at)
+
+    def stats(self):
+        return {name: limit.stats() for name, limit in self.limits.items()}
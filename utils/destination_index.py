@@ -0,0 +1,106 @@
+import bisect
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+from sqlalchemy import select, func
+
+from utils.pg_listener import PgListener
+
+
+class DestinationIndex(object):
+    """Process-local prefix index of the destinations with upcoming arrangements, for autocompletion.
+
+    Loaded when the app starts serving, kept up to date by the destinations_changed notification
+    every worker gets once an arrangement write commits, and rebuilt every
+    DESTINATION_INDEX_REBUILD_INTERVAL seconds so departed arrangements drop out.
+    """
+
+    channel = "destinations_changed"
+
+    def __init__(self, app=None, model=None):
+        # (rebuild at, sorted (casefolded name, name) entries, name -> upcoming arrangements)
+        self.index = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, model)
+
+    def init_app(self, app, model):
+        app.config.setdefault("DESTINATION_INDEX_REBUILD_INTERVAL", 3600)
+        app.config.setdefault("AUTOCOMPLETE_MAX_RESULTS", 50)
+        self.model = model
+        self.rebuild_interval = app.config["DESTINATION_INDEX_REBUILD_INTERVAL"]
+        app.before_first_request(self.load)
+
+    def load(self):
+        rows = self.model.query.session.execute(
+            select(self.model.destination, func.count())
+                .where(self.model.start_date >= datetime.date.today(), self.model.cancelled.isnot(True))
+                .group_by(self.model.destination)
+        ).all()
+
+        index = (
+            time.monotonic() + self.rebuild_interval,
+            sorted((destination.casefold(), destination) for destination, _ in rows),
+            {destination: count for destination, count in rows},
+        )
+        with self.lock:
+            self.index = index
+        return index
+
+    def _get_index(self):
+        index = self.index
+        if index is None or index[0] < time.monotonic():
+            index = self.load()
+        return index
+
+    def complete(self, prefix, limit):
+        """The destinations starting with the prefix (case insensitive) with the most upcoming arrangements."""
+        _, entries, counts = self._get_index()
+        prefix = prefix.casefold()
+
+        start = bisect.bisect_left(entries, (prefix,))
+        matches = itertools.takewhile(lambda entry: entry[0].startswith(prefix), itertools.islice(entries, start, None))
+
+        return [
+            {"destination": destination, "arrangements": counts[destination]}
+            for destination in heapq.nlargest(limit, (destination for _, destination in matches),
+                                              key=lambda destination: counts[destination])
+        ]
+
+    def track(self, arrangement, sign=1):
+        # like the calendar: counts the arrangement in, or out with sign=-1, inside the writing transaction
+        if arrangement.cancelled or arrangement.start_date < datetime.date.today():
+            return
+
+        PgListener.notify(self.model.query.session, self.channel,
+                          {"destination": arrangement.destination, "delta": sign})
+
+    def apply(self, payload):
+        # called by the listener thread, None (after a reconnect) reloads the index on its next use;
+        # a change racing a reload can be counted wrong until the next rebuild
+        with self.lock:
+            if payload is None or self.index is None:
+                self.index = None
+                return
+
+            rebuild_at, entries, counts = self.index
+            destination = payload["destination"]
+            count = counts.get(destination, 0) + payload["delta"]
+
+            # readers keep using the lists they already have, changes go to copies
+            counts = dict(counts)
+            entry = (destination.casefold(), destination)
+            if count > 0:
+                if destination not in counts:
+                    entries = list(entries)
+                    bisect.insort(entries, entry)
+                counts[destination] = count
+            elif destination in counts:
+                entries = list(entries)
+                entries.remove(entry)
+                del counts[destination]
+
+            self.index = (rebuild_at, entries, counts)
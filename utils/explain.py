@@ -0,0 +1,120 @@
+import json
+import sys
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from config.extensions import db
+from models.models import User, AccountType
+
+# every list endpoint with the sorts and filters that change the generated sql, paired with
+# the role of the user making the request (None for anonymous requests)
+LIST_ENDPOINTS = [
+    ("/arrangements/page/1", None),
+    ("/arrangements/page/1?dest=a", None),
+    ("/arrangements/page/1?start-date=2000-01-01&end-date=2100-01-01", None),
+    ("/arrangements/page/1?sort=price-a", "ADMIN"),
+    ("/arrangements/page/1?sort=end-date-d", "ADMIN"),
+    ("/arrangements/page/1?sort=destination-a", "ADMIN"),
+    ("/arrangements/page/1?sort=number-of-seats-d", "ADMIN"),
+    ("/arrangements/own", "ADMIN"),
+    ("/arrangements/own", "GUIDE"),
+    ("/arrangements/available", "TOURIST"),
+    ("/users/page/1", "ADMIN"),
+    ("/users/page/1?type=GUIDE", "ADMIN"),
+    ("/users/page/1?sort=email-a", "ADMIN"),
+    ("/users/page/1?sort=last-name-d", "ADMIN"),
+    ("/reservations/page/1", "ADMIN"),
+    ("/reservations/own", "TOURIST"),
+    ("/acc-type-change/page/1", "ADMIN"),
+    ("/acc-type-change/page/1?sort=confirmation-date-d", "ADMIN"),
+    ("/acc-type-change/own", "TOURIST"),
+]
+
+
+def find_seq_scans(plan, threshold):
+    found = []
+    rows = plan.get("Actual Rows", plan.get("Plan Rows", 0)) * plan.get("Actual Loops", 1)
+
+    if plan.get("Node Type") == "Seq Scan" and rows > threshold:
+        found.append((plan.get("Relation Name"), rows))
+
+    for sub_plan in plan.get("Plans", []):
+        found.extend(find_seq_scans(sub_plan, threshold))
+
+    return found
+
+
+def get_auth_header(role):
+    if role is None:
+        return {}
+
+    user = User.query.join(User.account_type).filter(AccountType.name == role).first()
+    if user is None:
+        return None
+
+    from schemas.schemas_rest import user_schema
+    return {"Authorization": f"Bearer {create_access_token(identity=user_schema.dump(user))}"}
+
+
+def capture_statements(client, url, headers):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        client.get(url, headers=headers)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    return statements
+
+
+@click.command("explain-endpoints")
+@click.option("-t", "--threshold", "threshold", type=int, default=None,
+              help="Flag sequential scans over more rows than this.")
+@with_appcontext
+def explain_endpoints(threshold):
+    """Runs EXPLAIN (ANALYZE, BUFFERS) on the sql every list endpoint generates."""
+    if threshold is None:
+        threshold = current_app.config.get("EXPLAIN_SEQ_SCAN_ROW_THRESHOLD")
+
+    client = current_app.test_client()
+    flagged = 0
+
+    for url, role in LIST_ENDPOINTS:
+        headers = get_auth_header(role)
+        if headers is None:
+            print(f"SKIP {url}: no {role} user in the database.")
+            continue
+
+        for statement, parameters in capture_statements(client, url, headers):
+            connection = db.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+            finally:
+                connection.rollback()
+                connection.close()
+
+            seq_scans = find_seq_scans(plan[0]["Plan"], threshold)
+            status = "SEQ SCAN" if seq_scans else "OK"
+            flagged += len(seq_scans)
+
+            print(f"{status:8} {role or 'anonymous':9} {url}")
+            for relation, rows in seq_scans:
+                print(f"{'':8} sequential scan on {relation} over {rows} rows")
+            print(f"{'':8} {' '.join(statement.split())}")
+
+    print(f"\n{flagged} sequential scans over {threshold} rows found.")
+    if flagged:
+        sys.exit(1)
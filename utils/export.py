@@ -0,0 +1,122 @@
+import csv
+import gzip
+import io
+import json
+import zlib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, func
+from sqlalchemy.dialects import postgresql
+
+from config.extensions import db
+from models.models import Reservation, Arrangement, User, AccountType, user_type_table, reservation_price_expression
+
+EXPORT_FORMATS = ("csv", "ndjson")
+
+EXPORTS = {
+    "reservations": select(
+        Reservation.arrangement_id,
+        Reservation.customer_id,
+        Reservation.seats_needed,
+        Arrangement.destination,
+        Arrangement.start_date,
+        Arrangement.end_date,
+        Arrangement.price,
+        reservation_price_expression(Reservation.seats_needed, Arrangement.price).label("total_price"),
+        User.username,
+        User.email,
+        User.first_name,
+        User.last_name,
+    ).join(Arrangement, Arrangement.id == Reservation.arrangement_id)
+        .join(User, User.id == Reservation.customer_id)
+        .order_by(Reservation.arrangement_id, Reservation.customer_id),
+
+    "users": select(
+        User.id,
+        User.username,
+        User.email,
+        User.first_name,
+        User.last_name,
+        func.string_agg(AccountType.name, ",").label("account_types"),
+    ).outerjoin(user_type_table, user_type_table.c.user_id == User.id)
+        .outerjoin(AccountType, AccountType.id == user_type_table.c.account_type_id)
+        .group_by(User.id)
+        .order_by(User.id),
+}
+
+
+def encode_rows(columns, partitions, export_format):
+    """Turns the partitions of rows into chunks of bytes, the csv header first."""
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+
+        for rows in partitions:
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+    else:
+        for rows in partitions:
+            yield "".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows).encode()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(engine, name, export_format, batch_size, compress=False):
+    """Yields the export as chunks of bytes, reading it through a server side cursor.
+
+    Owns its connection, so the generator can outlive the request context that made it.
+    """
+    statement = EXPORTS[name]
+
+    def generate():
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, max_row_buffer=batch_size) \
+                .execute(statement)
+            yield from encode_rows(list(result.keys()), result.partitions(batch_size), export_format)
+
+    return gzip_chunks(generate()) if compress else generate()
+
+
+def copy_statement(name):
+    compiled = EXPORTS[name].compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    return f"COPY ({compiled}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+
+@click.command("export")
+@click.argument("name", type=click.Choice(list(EXPORTS)))
+@click.option("-f", "--format", "export_format", type=click.Choice(EXPORT_FORMATS), default="csv")
+@click.option("-o", "--output", "output", default="-", help="File to write, stdout by default.")
+@click.option("-z", "--gzip", "compress", is_flag=True, help="Gzip the output.")
+@with_appcontext
+def export_data(name, export_format, output, compress):
+    """Exports all the reservations or users, csv goes through COPY, ndjson through a server side cursor."""
+    with click.open_file(output, "wb") as file:
+        target = gzip.GzipFile(fileobj=file, mode="wb") if compress else file
+
+        if export_format == "csv":
+            connection = db.engine.raw_connection()
+            try:
+                connection.cursor().copy_expert(copy_statement(name), target)
+            finally:
+                connection.rollback()
+                connection.close()
+        else:
+            for chunk in stream_export(db.engine, name, export_format, current_app.config["EXPORT_BATCH_SIZE"]):
+                target.write(chunk)
+
+        if compress:
+            target.close()
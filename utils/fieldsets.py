@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+
+def requested_fields(args, allowed):
+    """Parses the fields=a,b,c argument against the allow-list, None when it's missing.
+
+    Raises ValueError naming the fields which aren't allowed.
+    """
+    raw_fields = args.get('fields', None)
+    if raw_fields is None:
+        return None
+
+    fields = tuple(dict.fromkeys(field.strip() for field in raw_fields.split(',') if field.strip()))
+    if not fields:
+        raise ValueError("No fields requested.")
+
+    if invalid := [field for field in fields if field not in allowed]:
+        raise ValueError(f"Invalid fields: {', '.join(invalid)}.")
+
+    return fields
+
+
+def projection(allowed, fields):
+    # the columns (or sql expressions) which load just the requested fields
+    return [allowed[field] for field in fields]
+
+
+@lru_cache(maxsize=256)
+def sparse_schema(schema_class, fields=None, many=False):
+    # building a schema is far slower than dumping with it, each fieldset gets built once
+    return schema_class(only=fields, many=many)
@@ -0,0 +1,182 @@
+import bisect
+import datetime
+import heapq
+import json
+from collections import defaultdict
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, insert, values, column, Integer
+
+from config.extensions import db, account_types, hot_reads
+from models.models import Arrangement, ChangeLogEntry, user_type_table
+from utils.change_feed import arrangement_data
+
+# arrangements assigned per UPDATE ... FROM (VALUES ...) statement
+APPLY_CHUNK_SIZE = 5000
+
+
+def trip_days(start_date, end_date):
+    return (end_date - start_date).days + 1
+
+
+def conflicting_commitment(commitments, start_date, end_date):
+    # commitments are (starts, ends) of a guide's non overlapping trips, sorted; dates are inclusive
+    if commitments is None:
+        return None
+
+    starts, ends = commitments
+    i = bisect.bisect_left(ends, start_date)
+    if i < len(ends) and starts[i] <= end_date:
+        return starts[i], ends[i]
+    return None
+
+
+def plan_assignments(arrangements, guide_ids, commitments):
+    """Assigns guides to the arrangements so no guide has two trips on the same day.
+
+    The arrangements are (id, start date, end date) sorted by start date, commitments maps
+    a guide to the (start date, end date) trips they already have. Goes through the arrangements
+    in order, giving each to the free guide with the fewest days of trips so far, which staffs
+    every arrangement whenever there are as many guides as overlapping trips.
+
+    Returns the plan (arrangement id -> guide id), the unassigned arrangement ids and the
+    days of trips per guide.
+    """
+    load = dict.fromkeys(guide_ids, 0)
+    trips = {}
+    for guide_id, intervals in commitments.items():
+        if guide_id not in load:
+            continue
+        intervals = sorted(intervals)
+        trips[guide_id] = ([start for start, _ in intervals], [end for _, end in intervals])
+        load[guide_id] += sum(trip_days(start, end) for start, end in intervals)
+
+    # guides free for the next arrangement by (load, id), guides on a trip by (last day, id)
+    free = [(guide_load, guide_id) for guide_id, guide_load in load.items()]
+    heapq.heapify(free)
+    busy = []
+
+    plan = {}
+    unassigned = []
+
+    for arrangement_id, start_date, end_date in arrangements:
+        while busy and busy[0][0] < start_date:
+            _, guide_id = heapq.heappop(busy)
+            heapq.heappush(free, (load[guide_id], guide_id))
+
+        passed_over = []
+        while free:
+            guide_load, guide_id = heapq.heappop(free)
+
+            conflict = conflicting_commitment(trips.get(guide_id), start_date, end_date)
+            if conflict is None:
+                plan[arrangement_id] = guide_id
+                load[guide_id] += trip_days(start_date, end_date)
+                heapq.heappush(busy, (end_date, guide_id))
+                break
+
+            conflict_start, conflict_end = conflict
+            if conflict_start <= start_date:
+                # already on that trip, not worth looking at again before it ends
+                heapq.heappush(busy, (conflict_end, guide_id))
+            else:
+                # free now but leaving before this arrangement ends, can still take a later one
+                passed_over.append((guide_load, guide_id))
+        else:
+            unassigned.append(arrangement_id)
+
+        for entry in passed_over:
+            heapq.heappush(free, entry)
+
+    return plan, unassigned, load
+
+
+def schedule_guides(dry_run=False):
+    """Assigns guides to all the unassigned upcoming arrangements in one transaction.
+
+    The upcoming arrangements stay locked until the plan commits, so no assignment made
+    meanwhile can conflict with it. A dry run only computes the plan.
+    """
+    today = datetime.date.today()
+    guide_ids = db.session.execute(
+        select(user_type_table.c.user_id)
+            .where(user_type_table.c.account_type_id == account_types.id_of("GUIDE"))
+            .order_by(user_type_table.c.user_id)
+    ).scalars().all()
+
+    statement = select(*Arrangement.__table__.columns) \
+        .where(Arrangement.end_date >= today, Arrangement.cancelled.isnot(True)) \
+        .order_by(Arrangement.start_date, Arrangement.end_date, Arrangement.id)
+    if not dry_run:
+        statement = statement.with_for_update()
+    arrangements = db.session.execute(statement).all()
+
+    commitments = defaultdict(list)
+    unguided = []
+    for arrangement in arrangements:
+        if arrangement.guide_id is not None:
+            commitments[arrangement.guide_id].append((arrangement.start_date, arrangement.end_date))
+        elif arrangement.start_date > today:
+            unguided.append(arrangement)
+
+    plan, unassigned, load = plan_assignments(
+        [(arrangement.id, arrangement.start_date, arrangement.end_date) for arrangement in unguided],
+        guide_ids, commitments
+    )
+
+    if dry_run or not plan:
+        db.session.rollback()
+    else:
+        apply_plan(plan, unguided)
+        db.session.commit()
+
+    return plan, unassigned, load
+
+
+def apply_plan(plan, arrangements):
+    assignments = list(plan.items())
+    for i in range(0, len(assignments), APPLY_CHUNK_SIZE):
+        chunk = values(column("id", Integer), column("guide_id", Integer), name="plan") \
+            .data(assignments[i:i + APPLY_CHUNK_SIZE])
+        db.session.execute(
+            update(Arrangement)
+                .where(Arrangement.id == chunk.c.id, Arrangement.guide_id.is_(None))
+                .values(guide_id=chunk.c.guide_id)
+                .execution_options(synchronize_session=False)
+        )
+
+    db.session.execute(insert(ChangeLogEntry), [
+        {
+            "entity": "arrangement",
+            "entity_id": str(arrangement.id),
+            "operation": "update",
+            "data": {**arrangement_data(arrangement), "guide_id": plan[arrangement.id]},
+        }
+        for arrangement in arrangements if arrangement.id in plan
+    ])
+
+    # one notification dropping every cached read instead of one per arrangement
+    hot_reads.changed(None)
+
+
+def plan_summary(plan, unassigned, load):
+    return {
+        "assigned": len(plan),
+        "unassigned": unassigned,
+        "plan": [{"arrangement_id": arrangement_id, "guide_id": guide_id} for arrangement_id, guide_id in plan.items()],
+        "guide_days": [{"guide_id": guide_id, "days": days} for guide_id, days in load.items()],
+    }
+
+
+@click.command("schedule-guides")
+@click.option("-n", "--dry-run", "dry_run", is_flag=True, help="Print the plan without applying it.")
+@with_appcontext
+def schedule_guides_command(dry_run):
+    """Assigns guides to all the unassigned upcoming arrangements."""
+    plan, unassigned, load = schedule_guides(dry_run)
+
+    if dry_run:
+        print(json.dumps(plan_summary(plan, unassigned, load), indent=2))
+    else:
+        print(f"Assigned guides to {len(plan)} arrangements, {len(unassigned)} left without a guide.")
@@ -0,0 +1,136 @@
+import datetime
+import hashlib
+import math
+from functools import wraps
+
+import click
+import flask_jwt_extended
+from flask import request, current_app, Response
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from config.extensions import db
+
+# takes the key unless another request holds it: a fresh insert, or a takeover of a key
+# whose handler died without finishing (lock expired) or which expired altogether
+CLAIM_QUERY = text(
+    'INSERT INTO idempotency_key (key, request_hash, locked_until, expires_at) '
+    'VALUES (:key, :request_hash, :locked_until, :expires_at) '
+    'ON CONFLICT (key) DO UPDATE SET '
+        'request_hash = EXCLUDED.request_hash, '
+        'status_code = NULL, '
+        'response_body = NULL, '
+        'locked_until = EXCLUDED.locked_until, '
+        'expires_at = EXCLUDED.expires_at '
+    'WHERE '
+        '(idempotency_key.status_code IS NULL AND idempotency_key.locked_until < :now) '
+    'OR '
+        'idempotency_key.expires_at < :now '
+    'RETURNING key;'
+)
+
+STORED_QUERY = text(
+    'SELECT request_hash, status_code, response_body, locked_until FROM idempotency_key WHERE key = :key;'
+)
+
+COMPLETE_QUERY = text(
+    'UPDATE idempotency_key SET status_code = :status_code, response_body = :response_body '
+    'WHERE key = :key;'
+)
+
+RELEASE_QUERY = text('DELETE FROM idempotency_key WHERE key = :key;')
+
+SWEEP_QUERY = text(
+    'DELETE FROM idempotency_key WHERE key IN ('
+        'SELECT key FROM idempotency_key '
+        'WHERE expires_at < :now '
+        'LIMIT :batch_size '
+        'FOR UPDATE SKIP LOCKED'
+    ');'
+)
+
+
+def execute(query, **params):
+    # key bookkeeping runs in its own short transactions, apart from the handler's session
+    with db.engine.begin() as connection:
+        result = connection.execute(query, **params)
+        return result.first() if result.returns_rows else result.rowcount
+
+
+def idempotent(fn):
+    """Replays the stored response when a request is repeated with the same Idempotency-Key header."""
+    @wraps(fn)
+    def decorator(*args, **kwargs):
+        idempotency_key = request.headers.get("Idempotency-Key", None)
+        if idempotency_key is None:
+            return fn(*args, **kwargs)
+
+        if len(idempotency_key) > 128:
+            return {"msg": "Idempotency key too long."}, 400
+
+        identity = flask_jwt_extended.get_jwt_identity() or {}
+        key = f"{identity.get('id')}:{request.endpoint}:{idempotency_key}"
+        request_hash = hashlib.sha256(request.method.encode() + request.path.encode() + request.get_data()).hexdigest()
+
+        now = datetime.datetime.now()
+        claimed = execute(
+            CLAIM_QUERY,
+            key=key,
+            request_hash=request_hash,
+            locked_until=now + current_app.config["IDEMPOTENCY_LOCK_TIMEOUT"],
+            expires_at=now + current_app.config["IDEMPOTENCY_KEY_TTL"],
+            now=now
+        )
+
+        if claimed is None:
+            return replay(key, request_hash)
+
+        try:
+            response = current_app.make_response(fn(*args, **kwargs))
+        except Exception:
+            execute(RELEASE_QUERY, key=key)
+            raise
+
+        # server errors are not stored, the client should be able to retry them
+        if response.status_code >= 500:
+            execute(RELEASE_QUERY, key=key)
+        else:
+            execute(COMPLETE_QUERY, key=key, status_code=response.status_code, response_body=response.get_data())
+
+        return response
+
+    return decorator
+
+
+def replay(key, request_hash):
+    stored = execute(STORED_QUERY, key=key)
+
+    # released in the meantime, the client can simply retry
+    if stored is None:
+        return {"msg": "A request with this idempotency key is in progress."}, 409, {"Retry-After": "1"}
+
+    if stored.request_hash != request_hash:
+        return {"msg": "Idempotency key was already used for a different request."}, 422
+
+    if stored.status_code is None:
+        retry_after = max(1, math.ceil((stored.locked_until - datetime.datetime.now()).total_seconds()))
+        return {"msg": "A request with this idempotency key is in progress."}, 409, {"Retry-After": str(retry_after)}
+
+    response = Response(stored.response_body, status=stored.status_code, mimetype="application/json")
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@click.command("sweep-idempotency-keys")
+@click.option("-b", "--batch-size", "batch_size", type=int, default=10000)
+@with_appcontext
+def sweep_idempotency_keys(batch_size):
+    """Deletes the expired idempotency keys in batches."""
+    deleted = 0
+    while True:
+        batch = execute(SWEEP_QUERY, now=datetime.datetime.now(), batch_size=batch_size)
+        deleted += batch
+        if batch < batch_size:
+            break
+
+    print(f"Deleted {deleted} expired idempotency keys.")
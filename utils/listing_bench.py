@@ -0,0 +1,80 @@
+import datetime
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from config.extensions import db, account_types
+from models.models import AccountTypeChangeRequest
+from utils.pagination import paginate
+
+
+def listing_cases():
+    """(name, rebuilt select, prebuilt Listing, params) of the list endpoints with their main filter shapes.
+
+    Rebuilding goes around the template caches, the way the listings built their selects on every request.
+    """
+    # app.py imports this module before the views are registered
+    from views.account_change_request import TYPE_CHANGE_REQUEST_SORTS, TYPE_CHANGE_REQUEST_LISTINGS
+    from views.arrangement import catalogue_template
+    from views.user import users_template
+
+    today = datetime.date.today()
+    cases = [
+        ("/arrangements/page/1", catalogue_template, (True, None, False, False, "start-date-a"), {}),
+        ("/arrangements/page/1?start-date&end-date&dest&sort=price-d", catalogue_template,
+         (True, None, True, True, "price-d"),
+         {"start_date": today, "end_date": today + datetime.timedelta(days=365), "destination": "%a%"}),
+        ("/arrangements/page/1?fields=id,destination", catalogue_template,
+         (True, ("id", "destination"), False, False, "start-date-a"), {}),
+        ("/users/page/1", users_template, (None, False, "id-a"), {}),
+        ("/users/page/1?type=GUIDE&sort=email-a", users_template, (None, True, "email-a"),
+         {"account_type_id": account_types.id_of("GUIDE")}),
+    ]
+
+    return [
+        (name, lambda template=template, key=key: template.__wrapped__(*key).select,
+         lambda template=template, key=key: template(*key), params)
+        for name, template, key, params in cases
+    ] + [
+        ("/acc-type-change/page/1?sort=confirmation-date-d",
+         lambda: select(AccountTypeChangeRequest).order_by(TYPE_CHANGE_REQUEST_SORTS["confirmation-date-d"]),
+         lambda: TYPE_CHANGE_REQUEST_LISTINGS["confirmation-date-d"], {}),
+    ]
+
+
+def microseconds_per_call(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+@click.command("bench-listings")
+@click.option("-n", "--iterations", "iterations", type=int, default=1000, help="Requests timed per listing.")
+@with_appcontext
+def bench_listings(iterations):
+    """Times building and running a page of each listing, rebuilding its select versus the prebuilt one.
+
+    The build column is constructing the paged select and its cache key, what every request paid
+    before the listings were prebuilt; the run column adds executing it against the database.
+    """
+    per_page = current_app.config["RESULTS_PER_PAGE"]
+
+    print(f"{'listing':<62}{'build (us)':>22}{'build + run (us)':>24}")
+    for name, rebuilt, prebuilt, params in listing_cases():
+        build_before = microseconds_per_call(
+            lambda: rebuilt().limit(per_page + 1).offset(0)._generate_cache_key(), iterations)
+        build_after = microseconds_per_call(
+            lambda: prebuilt().page._generate_cache_key(), iterations)
+
+        run_before = microseconds_per_call(
+            lambda: db.session.execute(rebuilt().limit(per_page + 1).offset(0), params).all(), iterations)
+        run_after = microseconds_per_call(
+            lambda: paginate(db.session, prebuilt(), 1, per_page, params), iterations)
+
+        print(f"{name:<62}{build_before:>10.1f} -> {build_after:>8.1f}{run_before:>12.1f} -> {run_after:>8.1f}")
+
+    db.session.rollback()
@@ -0,0 +1,48 @@
+import queue
+import threading
+import time
+
+
+class MailQueue(object):
+    """Sends mail from a background thread, so the request doesn't wait on the mail server.
+
+    The queue lives in the worker's memory, mail still queued when the worker stops is lost.
+    """
+
+    def __init__(self, app=None, mail=None):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        app.config.setdefault("MAIL_QUEUE_RETRIES", 3)
+        self.app = app
+        self.mail = mail
+
+    def put(self, message):
+        self.queue.put(message)
+        self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name="mail-queue", daemon=True)
+                self.thread.start()
+
+    def work(self):
+        while True:
+            message = self.queue.get()
+
+            with self.app.app_context():
+                for attempt in range(1, self.app.config["MAIL_QUEUE_RETRIES"] + 1):
+                    try:
+                        self.mail.send(message)
+                        break
+                    except Exception:
+                        self.app.logger.exception("Sending mail to %s failed (attempt %d).",
+                                                  ", ".join(message.recipients), attempt)
+                        time.sleep(attempt)
+
+            self.queue.task_done()
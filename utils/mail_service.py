@@ -3,7 +3,7 @@ import time
 from flask import current_app
 from flask_mail import Message
 
-from config.extensions import mail
+from config.extensions import mail, mail_queue
 
 
 def send_successful_registration(username, email, first_name, last_name):
@@ -19,18 +19,25 @@ def send_successful_registration(username, email, first_name, last_name):
     mail.send(msg)
 
 
+def account_change_request_message(user, acc_type_change_request):
+    return Message(subject="Account type change request process",
+                   recipients=[user.email],
+                   body=f"Greetings {user.username}."
+                        f"\n\nYour account type change request has been processed."
+                        f"\n\nYour request has been {'granted' if acc_type_change_request.granted else 'denied'}."
+                        f"\nAdmin comment is following:\n'{acc_type_change_request.comment}'"
+                        f"\n\nDate: {acc_type_change_request.confirmation_date}"
+                        f"\n\nFarewell!"
+                        f"\nAdmin team"
+                   )
+
+
 def send_account_change_request_notification(user, acc_type_change_request):
-    msg = Message(subject="Account type change request process",
-                  recipients=[user.email],
-                  body=f"Greetings {user.username}."
-                       f"\n\nYour account type change request has been processed."
-                       f"\n\nYour request has been {'granted' if acc_type_change_request.granted else 'denied'}."
-                       f"\nAdmin comment is following:\n'{acc_type_change_request.comment}'"
-                       f"\n\nDate: {acc_type_change_request.confirmation_date}"
-                       f"\n\nFarewell!"
-                       f"\nAdmin team"
-                  )
-    mail.send(msg)
+    mail.send(account_change_request_message(user, acc_type_change_request))
+
+
+def queue_account_change_request_notification(user, acc_type_change_request):
+    mail_queue.put(account_change_request_message(user, acc_type_change_request))
 
 
 def send_successful_reservation_notification(user, reservation, arrangement, change=False):
@@ -49,6 +56,27 @@ def send_successful_reservation_notification(user, reservation, arrangement, cha
     mail.send(msg)
 
 
+def waitlist_offer_message(user, hold):
+    return Message(subject=f"Seats freed up on the arrangement to {hold.arrangement.destination}",
+                   recipients=[user.email],
+                   body=f"Greetings {user.username}."
+                        f"\n\n{hold.seats_needed} seats you have been waiting for on the arrangement "
+                        f"with id {hold.arrangement_id} are now held for you until {hold.expires_at:%Y-%m-%d %H:%M}."
+                        f"\nYou can confirm the reservation via POST method on "
+                        f"{current_app.config.get('CURRENT_DOMAIN')}/reservations/holds/{hold.arrangement_id}/confirm"
+                        f"\n\nBest of luck!"
+                        f"\nAdmin team"
+                   )
+
+
+def send_waitlist_offer_notification(user, hold):
+    mail.send(waitlist_offer_message(user, hold))
+
+
+def queue_waitlist_offer_notification(user, hold):
+    mail_queue.put(waitlist_offer_message(user, hold))
+
+
 def send_reservation_cancelled_notification(user, reservation):
     msg = Message(subject=f"Reservation to  CANCELED",
                   recipients=[user.email],
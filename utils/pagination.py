@@ -0,0 +1,129 @@
+import json
+import time
+from functools import cached_property
+
+from flask import current_app
+from sqlalchemy import select, func, text, bindparam
+from sqlalchemy.dialects import postgresql
+
+from config.extensions import db
+
+TOTAL_MODES = ("exact", "estimate", "cached")
+
+# (compiled statement, params) -> (expires at, total), shared by the requests of a worker
+count_cache = {}
+
+
+class Listing(object):
+    """A prebuilt listing select, with the statements derived from it built once and kept with it.
+
+    The templates (e.g. catalogue_template in views/arrangement.py) return Listings, so they're cached
+    under the template arguments and page and count without building, hashing or compiling anything
+    new; the values of their filters, like the page limit and offset, are passed in params. A select
+    built for a single request is wrapped in a throwaway Listing, which goes away with the request.
+    """
+
+    def __init__(self, select_statement):
+        self.select = select_statement
+        # (ordered, paramstyle) -> compiled statement
+        self.compiled = {}
+
+    @cached_property
+    def page(self):
+        return self.select.limit(bindparam("page_limit")).offset(bindparam("page_offset"))
+
+    @cached_property
+    def count(self):
+        # the count wraps the page query itself, so it runs with exactly the same filters
+        return select(func.count()).select_from(self.select.order_by(None).subquery())
+
+    def compile(self, ordered=True, paramstyle=None):
+        key = (ordered, paramstyle)
+        if key not in self.compiled:
+            select_statement = self.select if ordered else self.select.order_by(None)
+            self.compiled[key] = select_statement.compile(dialect=postgresql.dialect(paramstyle=paramstyle))
+        return self.compiled[key]
+
+
+def as_listing(select_statement):
+    return select_statement if isinstance(select_statement, Listing) else Listing(select_statement)
+
+
+def paginate(connection, select_statement, page, results_per_page, params=None):
+    # one extra row tells us whether there is a next page without counting anything
+    rows = connection.execute(
+        as_listing(select_statement).page,
+        {**(params or {}), "page_limit": results_per_page + 1, "page_offset": (page - 1) * results_per_page}
+    ).all()
+
+    return rows[:results_per_page], len(rows) > results_per_page
+
+
+def estimate_count(connection, select_statement, params=None):
+    # the planner's row estimate for the filtered statement, read from pg_statistic instead of the rows
+    compiled = as_listing(select_statement).compile(ordered=False, paramstyle="named")
+    plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {compiled}"), {**compiled.params, **(params or {})}) \
+        .scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def cached_count(connection, select_statement, ttl, params=None):
+    listing = as_listing(select_statement)
+    compiled = listing.compile()
+    key = (compiled.string, repr(sorted({**compiled.params, **(params or {})}.items())))
+
+    expires_at, total = count_cache.get(key, (0, None))
+    if expires_at < time.monotonic():
+        total = connection.execute(listing.count, params).scalar()
+
+        if len(count_cache) > 1000:
+            count_cache.clear()
+        count_cache[key] = (time.monotonic() + ttl, total)
+
+    return total
+
+
+def get_total(connection, mode, select_statement, ttl=60, params=None):
+    """Counts the rows of a listing (a Listing or a select), mode being one of TOTAL_MODES."""
+    if mode == "exact":
+        return connection.execute(as_listing(select_statement).count, params).scalar()
+    elif mode == "estimate":
+        return estimate_count(connection, select_statement, params)
+    else:
+        return cached_count(connection, select_statement, ttl, params)
+
+
+def page_envelope(results, page, has_more, total=None):
+    envelope = {
+        "page": page,
+        "has_more": has_more,
+        "results": results,
+    }
+    if total is not None:
+        envelope["total"] = total
+
+    return envelope
+
+
+def paginated_response(select_statement, page, args, dump, params=None):
+    """Runs a page of a listing and wraps it in the page envelope.
+
+    The total is only counted when asked for with the total=exact|estimate|cached argument.
+    """
+    total_mode = args.get('total', None)
+    if total_mode is not None and total_mode not in TOTAL_MODES:
+        return {"msg": "Invalid total mode."}, 400
+
+    # a select built for this request is paged and counted through the same throwaway Listing
+    select_statement = as_listing(select_statement)
+
+    rows, has_more = paginate(db.session, select_statement, page, current_app.config['RESULTS_PER_PAGE'], params)
+
+    total = None
+    if total_mode is not None:
+        total = get_total(db.session, total_mode, select_statement, current_app.config['COUNT_CACHE_TTL'], params)
+
+    return page_envelope(dump(rows), page, has_more, total)
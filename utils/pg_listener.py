@@ -0,0 +1,94 @@
+import json
+import select
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy import select as sql_select
+
+
+class PgListener(object):
+    """One LISTEN connection per worker, dispatching postgres notifications to the subscribed callbacks.
+
+    Notifications are sent with notify() inside the writing transaction, so they are only
+    delivered (to every worker, this one included) once that transaction commits.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.callbacks = {}
+        self.thread = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault("PG_LISTENER_ENABLED", True)
+        self.db = db
+        self.app = app
+
+        if app.config["PG_LISTENER_ENABLED"]:
+            app.before_first_request(self.start)
+
+    def subscribe(self, channel, callback):
+        # the callback gets the decoded payload, or None after a reconnect when notifications may have been missed
+        self.callbacks.setdefault(channel, []).append(callback)
+
+    @staticmethod
+    def notify(session, channel, payload=None):
+        session.execute(sql_select(func.pg_notify(channel, json.dumps(payload))))
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None or not self.callbacks:
+                return
+
+            self.thread = threading.Thread(target=self.listen, name="pg-listener", daemon=True)
+            self.thread.start()
+
+    def connect(self):
+        engine = self.db.get_engine(self.app)
+
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        connection = engine.dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+
+        cursor = connection.cursor()
+        for channel in self.callbacks:
+            cursor.execute(f'LISTEN "{channel}";')
+
+        return connection
+
+    def dispatch(self, channel, payload):
+        for callback in self.callbacks.get(channel, []):
+            try:
+                callback(payload)
+            except Exception:
+                self.app.logger.exception("Notification callback for %s failed.", channel)
+
+    def listen(self):
+        while True:
+            try:
+                connection = self.connect()
+            except Exception:
+                self.app.logger.exception("Could not open the notification connection.")
+                time.sleep(5)
+                continue
+
+            # anything could have happened while we weren't listening
+            for channel in self.callbacks:
+                self.dispatch(channel, None)
+
+            try:
+                while True:
+                    if select.select([connection], [], [], 30) == ([], [], []):
+                        continue
+
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        self.dispatch(notification.channel, json.loads(notification.payload))
+
+            except Exception:
+                self.app.logger.exception("Notification connection lost.")
+                connection.close()
+                time.sleep(1)
@@ -0,0 +1,209 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_FORMATS = ("collapsed", "speedscope")
+
+
+class RequestProfile(object):
+    def __init__(self, endpoint, method, path):
+        self.endpoint = endpoint
+        self.method = method
+        self.path = path
+        self.started_at = time.perf_counter()
+        self.duration = None
+        self.stacks = Counter()
+        self.statements = []
+        self.statement_started_at = None
+
+
+def frame_stack(frame):
+    # root first, every frame named after its function and where the function is defined
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+
+    return tuple(reversed(stack))
+
+
+class RequestProfiler(object):
+    """Sampling profiler for single requests, switched on per request.
+
+    A sampled fraction of the requests, and the requests of admins sending the profile header,
+    get their thread's stack sampled by one background thread every PROFILE_INTERVAL seconds.
+    Requests which aren't profiled only pay for the decision and a dict lookup per SQL statement.
+    """
+
+    def __init__(self, app=None, account_types=None):
+        # thread ident -> profile of the request the thread is handling
+        self.active = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        if app is not None:
+            self.init_app(app, account_types)
+
+    def init_app(self, app, account_types):
+        app.config.setdefault("PROFILE_ENABLED", True)
+        app.config.setdefault("PROFILE_SAMPLE_RATE", 0.0)
+        app.config.setdefault("PROFILE_HEADER", "X-Profile")
+        app.config.setdefault("PROFILE_INTERVAL", 0.005)
+        app.config.setdefault("PROFILE_FORMAT", "collapsed")
+        app.config.setdefault("PROFILE_DIR", "profiles")
+
+        if not app.config["PROFILE_ENABLED"]:
+            return
+
+        if app.config["PROFILE_FORMAT"] not in PROFILE_FORMATS:
+            raise ValueError(f"PROFILE_FORMAT must be one of {', '.join(PROFILE_FORMATS)}.")
+
+        self.app = app
+        self.account_types = account_types
+        self.directory = os.path.join(app.root_path, app.config["PROFILE_DIR"])
+
+        app.before_request(self.start_profile)
+        app.teardown_request(self.stop_profile)
+
+        if not event.contains(Engine, "before_cursor_execute", self.before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def wants_profile(self):
+        if random.random() < self.app.config["PROFILE_SAMPLE_RATE"]:
+            return True
+
+        if self.app.config["PROFILE_HEADER"] not in request.headers:
+            return False
+
+        # the header alone is ignored, only admins can have their requests profiled on demand
+        try:
+            if verify_jwt_in_request(optional=True) is None:
+                return False
+            return self.account_types.name_of(get_jwt_identity()["account_type"][0]) == "ADMIN"
+        except Exception:
+            return False
+
+    def start_profile(self):
+        if not self.wants_profile():
+            return
+
+        with self.condition:
+            self.active[threading.get_ident()] = RequestProfile(request.endpoint, request.method, request.path)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.sample, name="request-profiler", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def stop_profile(self, exception=None):
+        with self.condition:
+            profile = self.active.pop(threading.get_ident(), None)
+
+        if profile is None:
+            return
+
+        profile.duration = time.perf_counter() - profile.started_at
+        try:
+            self.write(profile)
+        except OSError:
+            self.app.logger.exception("Could not write the profile of %s.", profile.endpoint)
+
+    def sample(self):
+        interval = self.app.config["PROFILE_INTERVAL"]
+
+        while True:
+            with self.condition:
+                while not self.active:
+                    self.condition.wait()
+                profiles = list(self.active.items())
+
+            frames = sys._current_frames()
+            for ident, profile in profiles:
+                frame = frames.get(ident)
+                if frame is not None:
+                    profile.stacks[frame_stack(frame)] += 1
+            del frames
+
+            time.sleep(interval)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self.active.get(threading.get_ident())
+        if profile is not None:
+            profile.statement_started_at = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self.active.get(threading.get_ident())
+        if profile is not None and profile.statement_started_at is not None:
+            profile.statements.append({
+                "statement": statement,
+                "started_at": round((profile.statement_started_at - profile.started_at) * 1000, 3),
+                "duration": round((time.perf_counter() - profile.statement_started_at) * 1000, 3),
+            })
+            profile.statement_started_at = None
+
+    def write(self, profile):
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = f"{profile.endpoint or 'unmatched'}.{int(time.time() * 1000)}.{threading.get_ident()}"
+        path = os.path.join(self.directory, name)
+
+        if self.app.config["PROFILE_FORMAT"] == "speedscope":
+            profile_path = f"{path}.speedscope.json"
+            with open(profile_path, "w") as file:
+                json.dump(self.speedscope(profile), file)
+        else:
+            # one 'frame;frame;frame count' line per stack, as read by flamegraph.pl and speedscope
+            profile_path = f"{path}.collapsed"
+            with open(profile_path, "w") as file:
+                for stack, count in profile.stacks.items():
+                    file.write(f"{';'.join(stack)} {count}\n")
+
+        # the statements go next to the samples, times in milliseconds from the start of the request
+        with open(f"{path}.sql.json", "w") as file:
+            json.dump({
+                "endpoint": profile.endpoint,
+                "method": profile.method,
+                "path": profile.path,
+                "duration": round(profile.duration * 1000, 3),
+                "samples": sum(profile.stacks.values()),
+                "sql_duration": round(sum(statement["duration"] for statement in profile.statements), 3),
+                "statements": profile.statements,
+            }, file, indent=2)
+
+        self.app.logger.info("Profile of %s written to %s.", profile.endpoint, profile_path)
+
+    def speedscope(self, profile):
+        frames = {}
+        samples = []
+        weights = []
+        interval = self.app.config["PROFILE_INTERVAL"]
+
+        for stack, count in profile.stacks.items():
+            samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+            weights.append(count * interval)
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": profile.endpoint,
+            "exporter": "tourist_api",
+            "shared": {"frames": [{"name": frame} for frame in frames]},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{profile.method} {profile.path}",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
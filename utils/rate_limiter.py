@@ -0,0 +1,104 @@
+import math
+import time
+
+from flask import current_app
+from sqlalchemy import text
+
+
+class MemoryBucketStore(object):
+    # buckets are immutable (tokens, timestamp) tuples which are swapped in a single
+    # dict assignment, so no lock is taken on the request path; under a race a bucket
+    # may admit one extra request, which is fine for abuse protection
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def consume(self, key, capacity, refill_rate):
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            self._trim(now, capacity, refill_rate)
+            return 0
+
+        self.buckets[key] = (tokens, now)
+        return math.ceil((1 - tokens) / refill_rate)
+
+    def _trim(self, now, capacity, refill_rate):
+        if len(self.buckets) <= self.max_keys:
+            return
+
+        # drop the buckets which would have been refilled by now anyway
+        for key, (tokens, updated_at) in list(self.buckets.items()):
+            if tokens + (now - updated_at) * refill_rate >= capacity:
+                self.buckets.pop(key, None)
+
+
+class DatabaseBucketStore(object):
+    # one atomic upsert per key, shared by all the workers using the same database
+    query_text = text(
+        'INSERT INTO rate_limit_bucket (key, tokens, updated_at, allowed) '
+        'VALUES (:key, :capacity - 1, :now, true) '
+        'ON CONFLICT (key) DO UPDATE SET '
+            'allowed = LEAST(:capacity, rate_limit_bucket.tokens '
+                '+ (:now - rate_limit_bucket.updated_at) * :refill_rate) >= 1, '
+            'tokens = LEAST(:capacity, rate_limit_bucket.tokens '
+                '+ (:now - rate_limit_bucket.updated_at) * :refill_rate) '
+                '- CASE WHEN LEAST(:capacity, rate_limit_bucket.tokens '
+                '+ (:now - rate_limit_bucket.updated_at) * :refill_rate) >= 1 THEN 1 ELSE 0 END, '
+            'updated_at = :now '
+        'RETURNING tokens, allowed;'
+    )
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def consume(self, key, capacity, refill_rate):
+        with self.engine.begin() as connection:
+            tokens, allowed = connection.execute(
+                self.query_text,
+                key=key,
+                capacity=capacity,
+                refill_rate=refill_rate,
+                now=time.time()
+            ).first()
+
+        if allowed:
+            return 0
+        return math.ceil((1 - tokens) / refill_rate)
+
+
+class RateLimiter(object):
+    def __init__(self, app=None, db=None):
+        self.app = app
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        app.config.setdefault("RATE_LIMIT_ENABLED", True)
+        app.config.setdefault("RATE_LIMIT_BACKEND", "memory")
+        app.config.setdefault("RATE_LIMITS", {})
+
+        if app.config["RATE_LIMIT_BACKEND"] == "database":
+            with app.app_context():
+                store = DatabaseBucketStore(db.engine)
+        else:
+            store = MemoryBucketStore(app.config.get("RATE_LIMIT_MAX_KEYS", 100000))
+
+        app.extensions["rate_limiter"] = store
+
+    def hit(self, scope, keys):
+        """Takes a token for every key and returns the seconds to wait, 0 if the call is allowed."""
+        if not current_app.config["RATE_LIMIT_ENABLED"] or scope not in current_app.config["RATE_LIMITS"]:
+            return 0
+
+        capacity, refill_rate = current_app.config["RATE_LIMITS"][scope]
+        store = current_app.extensions["rate_limiter"]
+
+        retry_after = 0
+        for key in keys:
+            retry_after = max(retry_after, store.consume(f"{scope}:{key}", capacity, refill_rate))
+
+        return retry_after
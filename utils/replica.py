@@ -0,0 +1,96 @@
+import itertools
+import time
+
+from flask import g, request, current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, orm, text
+
+
+def primary_read(fn):
+    """Keeps a read-only view on the primary, for reads which have to see the latest writes."""
+    fn.primary_read = True
+    return fn
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and (replica_engine := g.get("replica_engine")) is not None:
+            return replica_engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter(object):
+    # on a replica the lag is the time since the last replayed transaction, unless everything
+    # received has been replayed already; on a primary (or a second connection to the primary
+    # standing in as a replica) there is no lag at all
+    lag_query = text(
+        'SELECT CASE '
+            'WHEN NOT pg_is_in_recovery() THEN 0 '
+            'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+            'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) '
+        'END;'
+    )
+
+    def __init__(self, app=None):
+        self.app = app
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SQLALCHEMY_REPLICA_URIS", [])
+        app.config.setdefault("REPLICA_MAX_LAG_SECONDS", 5)
+        app.config.setdefault("REPLICA_LAG_CHECK_INTERVAL", 1)
+
+        engines = [create_engine(uri, pool_pre_ping=True) for uri in app.config["SQLALCHEMY_REPLICA_URIS"]]
+        app.extensions["replicas"] = {
+            "engines": engines,
+            "cycle": itertools.cycle(engines),
+            "lag": {},
+        }
+
+        if engines:
+            app.before_request(self.route_request)
+
+    @staticmethod
+    def route_request():
+        if request.method not in ("GET", "HEAD"):
+            return
+
+        view = current_app.view_functions.get(request.endpoint)
+        if view is None or getattr(view, "primary_read", False):
+            return
+
+        g.replica_engine = ReplicaRouter.choose_replica()
+
+    @staticmethod
+    def choose_replica():
+        replicas = current_app.extensions["replicas"]
+
+        # try every replica once, falling back to the primary if all of them are lagging
+        for _ in range(len(replicas["engines"])):
+            engine = next(replicas["cycle"])
+            if ReplicaRouter.replica_lag(engine) <= current_app.config["REPLICA_MAX_LAG_SECONDS"]:
+                return engine
+
+        return None
+
+    @staticmethod
+    def replica_lag(engine):
+        lags = current_app.extensions["replicas"]["lag"]
+        checked_at, lag = lags.get(engine, (0, None))
+
+        if time.monotonic() - checked_at > current_app.config["REPLICA_LAG_CHECK_INTERVAL"]:
+            try:
+                with engine.connect() as connection:
+                    lag = float(connection.execute(ReplicaRouter.lag_query).scalar())
+            except Exception:
+                # an unreachable replica is treated as an infinitely lagging one
+                lag = float("inf")
+            lags[engine] = (time.monotonic(), lag)
+
+        return lag
@@ -0,0 +1,88 @@
+import queue
+import threading
+
+from sqlalchemy import select, func, cast, Text
+
+
+class SeatSubscriber(object):
+    """The pending seat updates of a seat stream, the latest one per arrangement.
+
+    A slow client skips the counts it had no time to read, but always gets the newest count
+    of every arrangement it watches, and the pending updates never outgrow the watched ids.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def put(self, payload):
+        with self.condition:
+            # a newer count replaces the pending one and keeps its place in line
+            self.pending[payload["arrangement_id"]] = payload
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        # raises queue.Empty when nothing changed within the timeout, like queue.Queue.get
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending, timeout):
+                raise queue.Empty
+            arrangement_id = next(iter(self.pending))
+            return self.pending.pop(arrangement_id)
+
+
+class SeatBroker(object):
+    """Fans the seat_changes notifications out to the seat streams of this worker.
+
+    A seat change costs one notification, however many clients are watching the arrangement.
+    """
+
+    channel = "seat_changes"
+
+    def __init__(self, app=None, model=None):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, model)
+
+    def init_app(self, app, model):
+        self.model = model
+        app.config.setdefault("SEAT_STREAM_MAX_IDS", 50)
+        app.config.setdefault("SEAT_STREAM_KEEP_ALIVE", 15)
+
+    def subscribe(self, arrangement_ids):
+        subscriber = SeatSubscriber()
+        with self.lock:
+            for arrangement_id in arrangement_ids:
+                self.subscribers.setdefault(arrangement_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber, arrangement_ids):
+        with self.lock:
+            for arrangement_id in arrangement_ids:
+                watchers = self.subscribers.get(arrangement_id, set())
+                watchers.discard(subscriber)
+                if not watchers:
+                    self.subscribers.pop(arrangement_id, None)
+
+    def publish(self, payload):
+        # called by the listener thread, None means notifications may have been lost meanwhile
+        if payload is None:
+            return
+
+        with self.lock:
+            watchers = list(self.subscribers.get(payload["arrangement_id"], ()))
+
+        for subscriber in watchers:
+            subscriber.put(payload)
+
+    def seats_changed(self, arrangement_id):
+        # computed and sent by the database inside the writing transaction, delivered once it commits
+        self.model.query.session.execute(
+            select(func.pg_notify(
+                self.channel,
+                cast(func.json_build_object(
+                    'arrangement_id', self.model.id,
+                    'seats_available', self.model.seats_available
+                ), Text)
+            )).where(self.model.id == arrangement_id)
+        )
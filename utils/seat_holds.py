@@ -0,0 +1,87 @@
+import datetime
+import time
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, delete
+
+from config.extensions import db, seat_broker, hot_reads
+from models.models import Arrangement, SeatHold
+from utils.calendar import track_seats
+from utils.mail_service import send_waitlist_offer_notification
+from utils.waitlist import promote_waitlist, notify_offers
+
+
+def sweep_batch(batch_size):
+    """Deletes the expired holds on the arrangements of up to batch_size of them, giving their seats back.
+
+    The seats go to the waitlists first, the batch commits at once. Returns the number of holds deleted.
+    """
+    from views.arrangement import arrangement_key
+
+    now = datetime.datetime.now()
+    expired_on = select(SeatHold.arrangement_id) \
+        .where(SeatHold.expires_at < now) \
+        .order_by(SeatHold.expires_at) \
+        .limit(batch_size)
+
+    # the arrangements are locked before their holds, like in the reservation and hold writes,
+    # and the ones being written right now are left for the next run
+    arrangements = Arrangement.query \
+        .filter(Arrangement.id.in_(expired_on)) \
+        .with_for_update(key_share=True, skip_locked=True) \
+        .all()
+    if not arrangements:
+        db.session.rollback()
+        return 0
+
+    released = db.session.execute(
+        delete(SeatHold)
+            .where(SeatHold.arrangement_id.in_([arrangement.id for arrangement in arrangements]),
+                   SeatHold.expires_at < now)
+            .returning(SeatHold.arrangement_id, SeatHold.seats_needed)
+            .execution_options(synchronize_session=False)
+    ).all()
+
+    released_seats = defaultdict(int)
+    for arrangement_id, seats in released:
+        released_seats[arrangement_id] += seats
+
+    # expired holds already stopped counting as taken, but the calendar, the waitlist and
+    # the seat streams only learn about the seats now
+    offers = []
+    for arrangement in arrangements:
+        track_seats(arrangement, released_seats[arrangement.id])
+        offers.extend(promote_waitlist(arrangement))
+        seat_broker.seats_changed(arrangement.id)
+        hot_reads.changed(arrangement_key(arrangement.id))
+
+    db.session.commit()
+    notify_offers(offers, send_waitlist_offer_notification)
+    return len(released)
+
+
+@click.command("sweep-seat-holds")
+@click.option("-b", "--batch-size", "batch_size", type=int, default=None, help="Holds deleted per transaction.")
+@click.option("-e", "--every", "every", type=float, default=None,
+              help="Keep sweeping, waiting this many seconds between sweeps.")
+@with_appcontext
+def sweep_seat_holds(batch_size, every):
+    """Deletes the expired seat holds in batches, giving their seats back."""
+    if batch_size is None:
+        batch_size = current_app.config.get("SEAT_HOLD_SWEEP_BATCH_SIZE")
+
+    while True:
+        released = 0
+        while True:
+            batch = sweep_batch(batch_size)
+            released += batch
+            if batch < batch_size:
+                break
+
+        print(f"Released {released} expired seat holds.")
+        if every is None:
+            break
+        time.sleep(every)
@@ -0,0 +1,92 @@
+import threading
+import time
+
+from utils.pg_listener import PgListener
+
+
+class Flight(object):
+    def __init__(self):
+        # set by an invalidation while computing: the result may predate the write, so later
+        # readers start a new flight and the result isn't cached
+        self.detached = False
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces identical reads of a worker into one computation, whose result is reused for SINGLE_FLIGHT_TTL.
+
+    Writers call changed() with the key inside their transaction: the entry is dropped right away
+    and, through the hot_reads_changed notification, again in every worker once the write commits.
+    """
+
+    channel = "hot_reads_changed"
+
+    def __init__(self, app=None, session=None):
+        self.flights = {}
+        # key -> (expires at, result)
+        self.results = {}
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, session)
+
+    def init_app(self, app, session):
+        app.config.setdefault("SINGLE_FLIGHT_TTL", 0.5)
+        app.config.setdefault("SINGLE_FLIGHT_MAX_ENTRIES", 10000)
+        self.ttl = app.config["SINGLE_FLIGHT_TTL"]
+        self.max_entries = app.config["SINGLE_FLIGHT_MAX_ENTRIES"]
+        self.session = session
+
+    def do(self, key, compute):
+        with self.lock:
+            expires_at, result = self.results.get(key, (0, None))
+            if expires_at > time.monotonic():
+                return result
+
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                if flight.error is None and not flight.detached:
+                    if len(self.results) >= self.max_entries:
+                        self.results.clear()
+                    self.results[key] = (time.monotonic() + self.ttl, flight.result)
+            flight.done.set()
+
+    def invalidate(self, key=None):
+        # called by the listener thread too, None (after a reconnect) drops everything
+        with self.lock:
+            if key is None:
+                self.results.clear()
+                flights = list(self.flights.values())
+                self.flights.clear()
+            else:
+                self.results.pop(key, None)
+                flight = self.flights.pop(key, None)
+                flights = [flight] if flight is not None else []
+
+            # the readers already waiting on these get their results, the next ones compute again
+            for flight in flights:
+                flight.detached = True
+
+    def changed(self, key):
+        PgListener.notify(self.session, self.channel, key)
+        self.invalidate(key)
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import click
+from flask import current_app, has_request_context, request
+from flask.cli import with_appcontext
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("slow_queries")
+
+# bound parameters (psycopg2 and asyncpg styles), string and number literals, then the lists they leave behind
+NORMALIZATIONS = (
+    (re.compile(r"%\(\w+\)s|\$\d+|%s"), "?"),
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"(?<![\w.$])-?\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?, ...)"),
+    (re.compile(r"\s+"), " "),
+)
+
+
+def normalize_sql(statement):
+    """Strips the values out of a statement, so all the executions of one query look the same."""
+    for pattern, replacement in NORMALIZATIONS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def current_view():
+    if not has_request_context() or request.endpoint is None:
+        return None
+
+    view = current_app.view_functions.get(request.endpoint)
+    return f"{view.__module__}.{view.__name__}" if view is not None else request.endpoint
+
+
+class SlowQueryLog(object):
+    """Logs every statement slower than SLOW_QUERY_THRESHOLD as one JSON line of SLOW_QUERY_LOG.
+
+    SLOW_QUERY_EXPLAIN_RATE of the logged selects get their plan attached, explained on the same
+    connection right after they ran, inside a savepoint so a failing EXPLAIN can't break the transaction.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SLOW_QUERY_LOG_ENABLED", True)
+        app.config.setdefault("SLOW_QUERY_THRESHOLD", 100)
+        app.config.setdefault("SLOW_QUERY_EXPLAIN_RATE", 0.1)
+        app.config.setdefault("SLOW_QUERY_LOG", "slow_queries.log")
+
+        if not app.config["SLOW_QUERY_LOG_ENABLED"]:
+            return
+
+        self.app = app
+        self.threshold = app.config["SLOW_QUERY_THRESHOLD"] / 1000
+        self.explain_rate = app.config["SLOW_QUERY_EXPLAIN_RATE"]
+
+        path = os.path.join(app.root_path, app.config["SLOW_QUERY_LOG"])
+        if not any(getattr(handler, "baseFilename", None) == path for handler in logger.handlers):
+            handler = logging.FileHandler(path, delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+        if not event.contains(Engine, "before_cursor_execute", self.before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    @staticmethod
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_started_at"].pop()
+        if duration < self.threshold:
+            return
+
+        entry = {
+            "logged_at": datetime.utcnow().isoformat(),
+            "duration": round(duration * 1000, 3),
+            "view": current_view(),
+            "sql": normalize_sql(statement),
+        }
+
+        if (
+                conn.dialect.name == "postgresql" and
+                not executemany and
+                statement.lstrip().upper().startswith(("SELECT", "WITH")) and
+                random.random() < self.explain_rate
+        ):
+            entry["plan"] = self.explain(cursor.connection, statement, parameters)
+
+        logger.info(json.dumps(entry, default=str))
+
+    def explain(self, connection, statement, parameters):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+                plan = cursor.fetchone()[0]
+            except Exception as error:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                return {"error": str(error)}
+
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return json.loads(plan) if isinstance(plan, str) else plan
+
+        except Exception as error:
+            self.app.logger.warning("Could not explain a slow query: %s", error)
+            return None
+
+        finally:
+            cursor.close()
+
+
+def read_slow_query_log(path):
+    with open(path) as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+@click.command("slow-query-report")
+@click.option("-n", "--top", "top", type=int, default=10, help="Number of statements to show.")
+@click.option("-l", "--log", "path", default=None, help="Slow query log to read, SLOW_QUERY_LOG by default.")
+@click.option("-p", "--plans", "plans", is_flag=True, help="Show the last captured plan of each statement.")
+@with_appcontext
+def slow_query_report(top, path, plans):
+    """Ranks the statements of the slow query log by the total time spent in them."""
+    if path is None:
+        path = os.path.join(current_app.root_path, current_app.config.get("SLOW_QUERY_LOG", "slow_queries.log"))
+
+    if not os.path.exists(path):
+        print(f"No slow query log at {path}.")
+        return
+
+    statements = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0, "views": defaultdict(int), "plan": None})
+    for entry in read_slow_query_log(path):
+        statement = statements[entry["sql"]]
+        statement["count"] += 1
+        statement["total"] += entry["duration"]
+        statement["max"] = max(statement["max"], entry["duration"])
+        statement["views"][entry.get("view") or "(no request)"] += 1
+        if entry.get("plan"):
+            statement["plan"] = entry["plan"]
+
+    ranked = sorted(statements.items(), key=lambda item: item[1]["total"], reverse=True)[:top]
+
+    print(f"{'total ms':>12} {'count':>7} {'mean ms':>10} {'max ms':>10}")
+    for sql, statement in ranked:
+        print(f"{statement['total']:12.1f} {statement['count']:7} "
+              f"{statement['total'] / statement['count']:10.1f} {statement['max']:10.1f}")
+        print(f"{'':8} {sql}")
+
+        views = sorted(statement["views"].items(), key=lambda item: item[1], reverse=True)
+        print(f"{'':8} from {', '.join(f'{view} ({count})' for view, count in views)}")
+
+        if plans and statement["plan"] is not None:
+            print(json.dumps(statement["plan"], indent=2))
+        print()
@@ -0,0 +1,81 @@
+import json
+import subprocess
+import sys
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+# builds the app the way a worker does, in a fresh interpreter so nothing is imported yet
+PROBE = (
+    "import json, time\n"
+    "started_at = time.perf_counter()\n"
+    "import app\n"
+    "imported_at = time.perf_counter()\n"
+    "flask_app = app.create_app()\n"
+    "print(json.dumps({\n"
+    "    'import': imported_at - started_at,\n"
+    "    'create_app': time.perf_counter() - imported_at,\n"
+    "    'phases': flask_app.extensions['startup_timings'],\n"
+    "}))\n"
+)
+
+# our own modules are reported one by one, everything else by its top level package
+PROJECT_PACKAGES = ("app", "asgi", "config", "models", "schemas", "utils", "views")
+
+
+def parse_import_times(output):
+    # lines look like 'import time: <self us> | <cumulative us> | <indented module name>'
+    import_times = defaultdict(int)
+
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_time, _, module = line[len("import time:"):].split("|")
+        module = module.strip()
+        package = module.split(".")[0]
+
+        import_times[module if package in PROJECT_PACKAGES else package] += int(self_time)
+
+    return import_times
+
+
+@click.command("startup-report")
+@click.option("-b", "--budget", "budget", type=float, default=None, help="Startup time budget in milliseconds.")
+@click.option("-n", "--top", "top", type=int, default=15, help="Number of modules to show.")
+@with_appcontext
+def startup_report(budget, top):
+    """Breaks down the import and initialization time of a worker boot."""
+    if budget is None:
+        budget = current_app.config.get("STARTUP_TIME_BUDGET_MS")
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=current_app.root_path,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    import_times = parse_import_times(result.stderr)
+
+    print(f"{'module':40} {'self ms':>10}")
+    for module, self_time in sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"{module:40} {self_time / 1000:10.1f}")
+
+    print(f"\n{'phase':40} {'ms':>10}")
+    print(f"{'import app':40} {timings['import'] * 1000:10.1f}")
+    for phase, seconds in timings["phases"].items():
+        print(f"{'create_app ' + phase:40} {seconds * 1000:10.1f}")
+
+    total = (timings["import"] + timings["create_app"]) * 1000
+    print(f"\n{'total':40} {total:10.1f}")
+
+    if budget is not None and total > budget:
+        print(f"Startup took {total:.1f} ms, over the budget of {budget:.1f} ms.")
+        sys.exit(1)
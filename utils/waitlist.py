@@ -0,0 +1,93 @@
+import datetime
+
+from flask import current_app
+from sqlalchemy import select
+
+from config.extensions import db
+from models.models import Arrangement, SeatHold, User, WaitlistEntry
+from utils.calendar import track_seats
+from utils.mail_service import queue_waitlist_offer_notification
+
+
+def promote_waitlist(arrangement):
+    """Offers the free seats of the arrangement to the head of its waitlist, as seat holds.
+
+    Runs in the transaction of the write which freed the seats, before its seats_changed. The
+    tourists are taken in order until one wants more seats than are left, so nobody is overtaken,
+    and no more of the queue is read than gets promoted. Returns the holds offered, to be mailed
+    with notify_offers once the transaction commits.
+    """
+    if arrangement.cancelled or arrangement.start_date - datetime.date.today() <= datetime.timedelta(days=5):
+        return []
+
+    # concurrent frees of the arrangement promote one after the other, each seeing the holds of the previous
+    db.session.flush()
+    seats_available = db.session.execute(
+        select(Arrangement.seats_available)
+            .where(Arrangement.id == arrangement.id)
+            .with_for_update(of=Arrangement, key_share=True)
+    ).scalar()
+    if seats_available <= 0:
+        return []
+
+    # every tourist wants at least a seat, so the queue is read no further than the seats available;
+    # entries being withdrawn right now are locked and skipped
+    entries = WaitlistEntry.query \
+        .filter_by(arrangement_id=arrangement.id) \
+        .order_by(WaitlistEntry.id) \
+        .limit(seats_available) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+    promoted = []
+    for entry in entries:
+        if entry.seats_needed > seats_available:
+            break
+        promoted.append(entry)
+        seats_available -= entry.seats_needed
+
+    if not promoted:
+        return []
+
+    # waiting tourists have no unexpired hold on the arrangement, an expired one not yet swept is taken over
+    expired_holds = {
+        hold.customer_id: hold for hold in SeatHold.query
+            .filter(SeatHold.arrangement_id == arrangement.id,
+                    SeatHold.customer_id.in_([entry.customer_id for entry in promoted]))
+            .with_for_update()
+    }
+
+    expires_at = datetime.datetime.now() + current_app.config["WAITLIST_HOLD_TTL"]
+    offers = []
+    for entry in promoted:
+        hold = expired_holds.get(entry.customer_id)
+        if hold is None:
+            hold = SeatHold(arrangement_id=arrangement.id, customer_id=entry.customer_id,
+                            seats_needed=entry.seats_needed)
+            db.session.add(hold)
+            track_seats(arrangement, -entry.seats_needed)
+        else:
+            track_seats(arrangement, hold.seats_needed - entry.seats_needed)
+            hold.seats_needed = entry.seats_needed
+
+        hold.expires_at = expires_at
+        db.session.delete(entry)
+        offers.append(hold)
+
+    return offers
+
+
+def leave_waitlist(arrangement_id, customer_id):
+    # a tourist who got seats some other way stops waiting for them
+    WaitlistEntry.query.filter_by(arrangement_id=arrangement_id, customer_id=customer_id) \
+        .delete(synchronize_session=False)
+
+
+def drop_waitlist(arrangement_id):
+    # nobody waits for an arrangement which is cancelled or deleted
+    WaitlistEntry.query.filter_by(arrangement_id=arrangement_id).delete(synchronize_session=False)
+
+
+def notify_offers(offers, send=queue_waitlist_offer_notification):
+    for hold in offers:
+        send(User.query.filter_by(id=hold.customer_id).first(), hold)
@@ -1,20 +1,35 @@
 import datetime
 
 import marshmallow
-from flask import jsonify, current_app, request, Blueprint
+from flask import jsonify, request, Blueprint, current_app
 from flask_jwt_extended import jwt_required
-from sqlalchemy import select
+from sqlalchemy import select, insert, delete
 
 from views.auth import roles_required, get_current_user_custom
-from config.extensions import db
-from utils.mail_service import send_account_change_request_notification
-from models.models import AccountTypeChangeRequest, AccountType, User
+from config.extensions import account_types, db
+from utils.mail_service import send_account_change_request_notification, queue_account_change_request_notification
+from utils.pagination import paginated_response, Listing
+from utils.replica import primary_read
+from models.models import AccountTypeChangeRequest, User, user_type_table
 from schemas.schemas_rest import account_type_change_requests_schema, account_type_change_request_schema, \
     base_account_type_change_request_schema
 
 acc_type_change_bp = Blueprint('account_change_request', __name__, url_prefix='/acc-type-change')
 
 
+TYPE_CHANGE_REQUEST_SORTS = {
+    "filing-date-a": AccountTypeChangeRequest.filing_date.asc(),
+    "filing-date-d": AccountTypeChangeRequest.filing_date.desc(),
+    "confirmation-date-a": AccountTypeChangeRequest.confirmation_date.asc(),
+    "confirmation-date-d": AccountTypeChangeRequest.confirmation_date.desc(),
+}
+
+# the listing has no filters, so there's one prebuilt listing per sort
+TYPE_CHANGE_REQUEST_LISTINGS = {
+    sort: Listing(select(AccountTypeChangeRequest).order_by(order)) for sort, order in TYPE_CHANGE_REQUEST_SORTS.items()
+}
+
+
 @acc_type_change_bp.get('/page/<int:page_id>')
 @jwt_required()
 @roles_required("ADMIN")
@@ -22,30 +37,17 @@ def get_all_type_change_requests(page_id):
     if page_id <= 0:
         return {"msg": "Invalid page number."}, 400
 
-    sorts = {
-        "filing-date-a": AccountTypeChangeRequest.filing_date.asc(),
-        "filing-date-d": AccountTypeChangeRequest.filing_date.desc(),
-        "confirmation-date-a": AccountTypeChangeRequest.confirmation_date.asc(),
-        "confirmation-date-d": AccountTypeChangeRequest.confirmation_date.desc(),
-    }
-    wanted_sort = sorts.get("filing-date-a")
+    select_statement = TYPE_CHANGE_REQUEST_LISTINGS.get(request.args.get('sort', None),
+                                                        TYPE_CHANGE_REQUEST_LISTINGS["filing-date-a"])
 
-    if (sort := request.args.get('sort', None)) and sort:
-        if sorts.get(sort, None) is not None:
-            wanted_sort = sorts.get(sort)
-
-    raw_requests = db.session.execute(
-        select(AccountTypeChangeRequest)
-            .order_by(wanted_sort)
-            .limit(current_app.config['RESULTS_PER_PAGE'])
-            .offset((page_id - 1) * current_app.config['RESULTS_PER_PAGE'])
-    ).all()
-
-    return jsonify([account_type_change_request_schema.dump(req[0]) for req in raw_requests])
+    return paginated_response(select_statement, page_id, request.args,
+                              lambda raw_requests: [account_type_change_request_schema.dump(req[0])
+                                                    for req in raw_requests])
 
 
 @acc_type_change_bp.get('/own')
 @jwt_required()
+@primary_read
 def get_own_type_change_requests():
     user = get_current_user_custom()
 
@@ -56,6 +58,7 @@ def get_own_type_change_requests():
 
 @acc_type_change_bp.get('/<int:request_id>')
 @jwt_required()
+@primary_read
 def get_type_change_request(request_id):
     user = get_current_user_custom()
 
@@ -88,8 +91,7 @@ def submit_type_change_request():
         ):
             return {"msg": "Invalid account wanted type"}, 400
 
-        acc_type = AccountType.query.filter_by(name=wanted_type) \
-            .first_or_404(description="No such account type found.")
+        acc_type = account_types.get_or_404(name=wanted_type)
 
         change_request = base_account_type_change_request_schema.load(request.get_json())
 
@@ -129,9 +131,12 @@ def verify_type_change_request(request_id):
         change_request.confirmation_date = datetime.datetime.now()
         change_request.admin_confirmed_id = admin.id
 
+        if change_request.granted:
+            apply_wanted_types([change_request.id])
+
         AccountTypeChangeRequest.query.session.commit()
 
-        user = User.query.filter_by(change_request.user_id).first_or_404(description="No such user found.")
+        user = User.query.filter_by(id=change_request.user_id).first_or_404(description="No such user found.")
 
         send_account_change_request_notification(user, change_request)
 
@@ -142,3 +147,119 @@ def verify_type_change_request(request_id):
 
     except marshmallow.ValidationError as err:
         return err.messages, 400
+
+
+def apply_wanted_types(request_ids):
+    # a user has one account type, the granted requests replace it with their wanted type
+    if not request_ids:
+        return
+
+    user_ids = select(AccountTypeChangeRequest.user_id).where(AccountTypeChangeRequest.id.in_(request_ids))
+    db.session.execute(delete(user_type_table).where(user_type_table.c.user_id.in_(user_ids)))
+    db.session.execute(insert(user_type_table).from_select(
+        ["user_id", "account_type_id"],
+        select(AccountTypeChangeRequest.user_id, AccountTypeChangeRequest.wanted_type_id)
+            .where(AccountTypeChangeRequest.id.in_(request_ids))
+    ))
+
+
+def parse_decision(decision):
+    if not isinstance(decision, dict) or not isinstance(decision.get("id"), int):
+        raise ValueError("Decision id missing.")
+    if not isinstance(decision.get("granted"), bool):
+        raise ValueError("Granted field missing.")
+    if not isinstance(decision.get("comment"), str) or not 5 <= len(decision["comment"]) <= 1024:
+        raise ValueError("Invalid length of the comment.")
+
+    return decision["id"], decision["granted"], decision["comment"]
+
+
+@acc_type_change_bp.post('/decisions')
+@jwt_required()
+@roles_required("ADMIN")
+def decide_type_change_requests():
+    """Grants or denies many requests in one transaction, answering with the outcome of every decision."""
+    admin = get_current_user_custom()
+
+    decisions = (request.get_json(silent=True) or {}).get("decisions")
+    if not isinstance(decisions, list) or not decisions:
+        return {"msg": "Decisions missing."}, 400
+    if len(decisions) > current_app.config['TYPE_CHANGE_DECISIONS_MAX']:
+        return {"msg": f"At most {current_app.config['TYPE_CHANGE_DECISIONS_MAX']} decisions at once."}, 400
+
+    results = []
+    parsed = {}
+    for decision in decisions:
+        try:
+            request_id, granted, comment = parse_decision(decision)
+        except ValueError as err:
+            results.append({"id": decision.get("id") if isinstance(decision, dict) else None,
+                            "status": "invalid", "msg": str(err)})
+            continue
+
+        if request_id in parsed:
+            results.append({"id": request_id, "status": "invalid", "msg": "Duplicate decision."})
+            continue
+
+        parsed[request_id] = (granted, comment)
+        results.append({"id": request_id, "status": None})
+
+    # locked in id order, so two admins deciding overlapping batches can't deadlock
+    change_requests = {
+        change_request.id: change_request
+        for change_request in db.session.execute(
+            select(AccountTypeChangeRequest)
+                .where(AccountTypeChangeRequest.id.in_(parsed))
+                .order_by(AccountTypeChangeRequest.id)
+                .with_for_update()
+        ).scalars()
+    }
+
+    now = datetime.datetime.now()
+    decided = []
+    granted_users = set()
+    for result in results:
+        if result["status"] is not None:
+            continue
+
+        change_request = change_requests.get(result["id"])
+        if change_request is None:
+            result.update(status="not_found", msg="No such account type change request.")
+            continue
+        if change_request.confirmation_date is not None:
+            result.update(status="already_decided", msg="Request has already been decided.")
+            continue
+
+        granted, comment = parsed[result["id"]]
+        if granted:
+            if change_request.user_id in granted_users:
+                result.update(status="conflict", msg="Another request of the same user is granted in this batch.")
+                continue
+            granted_users.add(change_request.user_id)
+
+        change_request.granted = granted
+        change_request.comment = comment
+        change_request.confirmation_date = now
+        change_request.admin_confirmed_id = admin.id
+        result["status"] = "granted" if granted else "denied"
+        decided.append(change_request)
+
+    apply_wanted_types([change_request.id for change_request in decided if change_request.granted])
+
+    users = {
+        user.id: user
+        for user in db.session.execute(
+            select(User.id, User.email, User.username)
+                .where(User.id.in_({change_request.user_id for change_request in decided}))
+        )
+    }
+
+    db.session.commit()
+
+    for change_request in decided:
+        queue_account_change_request_notification(users[change_request.user_id], change_request)
+
+    return {
+        "msg": f"Decided {len(decided)} of {len(decisions)} account type change requests.",
+        "results": results
+    }
@@ -0,0 +1,112 @@
+import datetime
+
+from flask import Blueprint, request, current_app, Response
+from flask_jwt_extended import jwt_required
+from sqlalchemy import select
+
+from config.extensions import concurrency, db
+from models.models import ArchivedArrangement, ArchivedReservation
+from schemas.schemas_rest import archived_arrangements_schema, completed_archived_arrangement_schema
+from utils.export import EXPORTS, EXPORT_FORMATS, stream_export
+from utils.guide_scheduler import schedule_guides, plan_summary
+from utils.pagination import paginated_response
+from views.auth import roles_required
+
+admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+@admin_bp.get('/limits')
+@jwt_required()
+@roles_required("ADMIN")
+def get_concurrency_limits():
+    # left unprotected itself, so it still answers while the other blueprints shed load
+    return concurrency.stats()
+
+
+@admin_bp.get('/history/arrangements/page/<int:page_id>')
+@jwt_required()
+@roles_required("ADMIN")
+def get_archived_arrangements(page_id):
+    if page_id <= 0:
+        return {"msg": "Invalid page number."}, 400
+
+    select_statement = select(ArchivedArrangement)
+
+    try:
+        if req_start_date := request.args.get('start-date', None):
+            select_statement = select_statement.where(
+                ArchivedArrangement.start_date >= datetime.date.fromisoformat(req_start_date))
+        if req_end_date := request.args.get('end-date', None):
+            select_statement = select_statement.where(
+                ArchivedArrangement.start_date <= datetime.date.fromisoformat(req_end_date))
+    except ValueError:
+        return {"msg": "Invalid date format."}, 400
+
+    if dest := request.args.get('dest', None):
+        select_statement = select_statement.where(ArchivedArrangement.destination.like(f"%{dest}%"))
+
+    if (guide := request.args.get('guide', None, type=int)) is not None:
+        select_statement = select_statement.where(ArchivedArrangement.guide_id == guide)
+
+    if (customer := request.args.get('customer', None, type=int)) is not None:
+        select_statement = select_statement.where(ArchivedArrangement.id.in_(
+            select(ArchivedReservation.arrangement_id).where(ArchivedReservation.customer_id == customer)
+        ))
+
+    sorts = {
+        "start-date-a": ArchivedArrangement.start_date.asc(),
+        "start-date-d": ArchivedArrangement.start_date.desc(),
+    }
+    select_statement = select_statement.order_by(
+        sorts.get(request.args.get('sort', None), ArchivedArrangement.start_date.desc()),
+        ArchivedArrangement.id.asc()
+    )
+
+    return paginated_response(select_statement, page_id, request.args,
+                              lambda rows: archived_arrangements_schema.dump(row[0] for row in rows))
+
+
+@admin_bp.get('/history/arrangements/<int:arrangement_id>')
+@jwt_required()
+@roles_required("ADMIN")
+def get_archived_arrangement(arrangement_id):
+    arrangement = ArchivedArrangement.query.filter_by(id=arrangement_id) \
+        .first_or_404(description="No such archived arrangement found.")
+
+    return completed_archived_arrangement_schema.dump(arrangement)
+
+
+@admin_bp.get('/export/<string:name>')
+@jwt_required()
+@roles_required("ADMIN")
+def export_data(name):
+    if name not in EXPORTS:
+        return {"msg": "No such export."}, 404
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return {"msg": "Invalid export format."}, 400
+
+    compress = request.args.get('gzip', 'false').lower() in ('1', 'true')
+    filename = f"{name}.{export_format}{'.gz' if compress else ''}"
+
+    if compress:
+        mimetype = "application/gzip"
+    else:
+        mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+
+    chunks = stream_export(db.engine, name, export_format, current_app.config['EXPORT_BATCH_SIZE'], compress)
+    return Response(chunks, mimetype=mimetype, headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+@admin_bp.post('/schedule-guides')
+@jwt_required()
+@roles_required("ADMIN")
+def schedule_arrangement_guides():
+    dry_run = request.args.get('dry-run', 'false').lower() in ('1', 'true')
+    plan, unassigned, load = schedule_guides(dry_run)
+
+    return {
+        "msg": "Guide schedule planned." if dry_run else "Guides assigned successfully.",
+        **plan_summary(plan, unassigned, load)
+    }
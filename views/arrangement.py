@@ -1,99 +1,314 @@
 import datetime
+import json
+import queue
+from functools import lru_cache
 
 import marshmallow
-from flask import request, current_app, jsonify, Blueprint
+from flask import request, current_app, jsonify, Blueprint, Response, abort
 from flask_jwt_extended import jwt_required, verify_jwt_in_request
-from sqlalchemy import select, text
+from sqlalchemy import select, text, func, bindparam
 
+from config.extensions import seat_broker, hot_reads, destinations
 from utils.mail_service import send_arrangement_cancelled_notification
-from models.models import Arrangement, User, Reservation
+from utils.calendar import track_arrangement
+from utils.change_feed import record_arrangement_change
+from utils.idempotency import idempotent
+from utils.fieldsets import requested_fields, projection, sparse_schema
+from utils.pagination import paginated_response, Listing
+from utils.waitlist import promote_waitlist, drop_waitlist, notify_offers
+from models.models import Arrangement, User, Reservation, ArrangementDayBucket
 from models.models import db
-from schemas.schemas_rest import basic_arrangements_schema, arrangement_schema, arrangements_schema
+from schemas.schemas_rest import arrangement_schema, ArrangementSchema, BasicArrangementSchema, ARRANGEMENT_FIELDS, \
+    BASIC_ARRANGEMENT_FIELDS
 from views.auth import roles_required, get_current_user_custom
 
 arrangements_bp = Blueprint('arrangements', __name__, url_prefix='/arrangements')
 
-
-@arrangements_bp.get('/page/<int:page>')
-def get_all_arrangements(page=1):
-    if page <= 0:
-        return {"msg": "Invalid page number."}, 400
-
-    # if user is logged in, the user gets fully detailed arrangements
-    # otherwise basic info
-    if verify_jwt_in_request(optional=True) is None:
-        schema = basic_arrangements_schema
-        select_statement = select(Arrangement.id, Arrangement.start_date, Arrangement.destination, Arrangement.price)
-    else:
-        schema = arrangements_schema
+# slower
+# AVAILABLE_ARRANGEMENTS_QUERY = text(
+#     'SELECT * FROM arrangement '
+#     'WHERE arrangement.start_date > CURRENT_DATE + 5 AND ('
+#     'SELECT COUNT(*) FROM reservation '
+#     'WHERE reservation.arrangement_id = arrangement.id AND reservation.customer_id = :curr_user_id'
+#     ') = 0;')
+
+# faster query
+# select all the arrangement with appropriate date which are not already reserved by the current user
+AVAILABLE_ARRANGEMENTS_QUERY = text(
+    'SELECT * FROM arrangement '
+    'WHERE '
+        'arrangement.start_date > CURRENT_DATE + 5 '
+    'AND '
+        'arrangement.id not in ('
+            'SELECT arrangement_id FROM reservation '
+            'WHERE '
+                'reservation.arrangement_id = arrangement.id '
+            'AND '
+                'reservation.customer_id = :curr_user_id'
+        ');'
+)
+
+
+ARRANGEMENT_SORTS = {
+    "price-a": Arrangement.price.asc(),
+    "price-d": Arrangement.price.desc(),
+    "start-date-a": Arrangement.start_date.asc(),
+    "start-date-d": Arrangement.start_date.desc(),
+    "end-date-a": Arrangement.end_date.asc(),
+    "end-date-d": Arrangement.end_date.desc(),
+    "destination-a": Arrangement.destination.asc(),
+    "destination-d": Arrangement.destination.desc(),
+    "number-of-seats-a": Arrangement.number_of_seats.asc(),
+    "number-of-seats-d": Arrangement.number_of_seats.desc(),
+}
+
+
+@lru_cache(maxsize=512)
+def catalogue_template(detailed, fields, between_dates, by_destination, sort):
+    # one prebuilt listing per shape of the catalogue request, the filter values are bound per request
+    if fields is not None:
+        select_statement = select(*projection(ARRANGEMENT_FIELDS, fields))
+    elif detailed:
         select_statement = select(Arrangement.id, Arrangement.start_date, Arrangement.end_date, Arrangement.destination,
                                   Arrangement.price, Arrangement.number_of_seats, Arrangement.description)
+    else:
+        select_statement = select(Arrangement.id, Arrangement.start_date, Arrangement.destination, Arrangement.price)
+
+    if between_dates:
+        select_statement = select_statement.filter(Arrangement.start_date >= bindparam("start_date"),
+                                                   Arrangement.end_date <= bindparam("end_date"))
+
+    if by_destination:
+        select_statement = select_statement.filter(Arrangement.destination.like(bindparam("destination")))
+
+    return Listing(select_statement.order_by(ARRANGEMENT_SORTS[sort]))
 
-    results_per_page = current_app.config.get('RESULTS_PER_PAGE')
-    sorts = {
-        "price-a": Arrangement.price.asc(),
-        "price-d": Arrangement.price.desc(),
-        "start-date-a": Arrangement.start_date.asc(),
-        "start-date-d": Arrangement.start_date.desc(),
-        "end-date-a": Arrangement.end_date.asc(),
-        "end-date-d": Arrangement.end_date.desc(),
-        "destination-a": Arrangement.destination.asc(),
-        "destination-d": Arrangement.destination.desc(),
-        "number-of-seats-a": Arrangement.number_of_seats.asc(),
-        "number-of-seats-d": Arrangement.number_of_seats.desc(),
-    }
+
+def catalogue_statement(args, detailed, fields=None):
+    """Picks the ordered catalogue select for the request args and its parameters, raises ValueError on malformed args.
+
+    Shared by the WSGI catalogue and the asyncio one in asgi.py.
+    """
+    params = {}
 
     # if we're trying to get arrangements between specific dates
     # parse them from request and return the appropriate results
-    req_start_date = request.args.get('start-date', None)
-    req_end_date = request.args.get('end-date', None)
+    req_start_date = args.get('start-date', None)
+    req_end_date = args.get('end-date', None)
     if req_start_date and req_end_date:
         try:
-            start_date = datetime.date.fromisoformat(req_start_date)
-            end_date = datetime.date.fromisoformat(req_end_date)
-
-            if end_date < start_date:
-                return {"msg": "Malformed dates."}, 400
-
-            select_statement = select_statement.filter(Arrangement.start_date >= start_date,
-                                                       Arrangement.end_date <= end_date)
-
+            params["start_date"] = datetime.date.fromisoformat(req_start_date)
+            params["end_date"] = datetime.date.fromisoformat(req_end_date)
         except ValueError:
-            return {"msg": "Invalid date format."}, 400
+            raise ValueError("Invalid date format.")
+
+        if params["end_date"] < params["start_date"]:
+            raise ValueError("Malformed dates.")
 
-    req_destination = request.args.get('dest', None)
+    req_destination = args.get('dest', None)
     if req_destination is not None:
-        select_statement = select_statement.filter(Arrangement.destination.like(f"%{req_destination}%"))
+        params["destination"] = f"%{req_destination}%"
 
     # if there is no sorting parameter in the request
     # or the parameter provided doesn't exist
-    # we return the arrangements paginated by start_date
+    # we return the arrangements ordered by start_date
     # otherwise we use the provided param
-    req_sort_param = request.args.get('sort', None)
-    if req_sort_param is None or sorts.get(req_sort_param, None) is None:
-        raw_arrangements = db.session.execute(
-            select_statement
-                .order_by(Arrangement.start_date.asc())
-                .limit(results_per_page)
-                .offset((page - 1) * results_per_page)
-        ).all()
+    sort = args.get('sort', None)
+    if sort not in ARRANGEMENT_SORTS:
+        sort = "start-date-a"
+
+    return catalogue_template(detailed, fields, "start_date" in params, "destination" in params, sort), params
+
+
+@arrangements_bp.get('/page/<int:page>')
+def get_all_arrangements(page=1):
+    if page <= 0:
+        return {"msg": "Invalid page number."}, 400
+
+    # if user is logged in, the user gets fully detailed arrangements
+    # otherwise basic info
+    detailed = verify_jwt_in_request(optional=True) is not None
+
+    try:
+        fields = requested_fields(request.args, ARRANGEMENT_FIELDS if detailed else BASIC_ARRANGEMENT_FIELDS)
+        select_statement, params = catalogue_statement(request.args, detailed, fields)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    schema = sparse_schema(ArrangementSchema if detailed else BasicArrangementSchema, fields, many=True)
+    return paginated_response(select_statement, page, request.args, schema.dump, params)
+
+
+@arrangements_bp.get('/calendar')
+def get_calendar():
+    # answered from the day buckets, a year is at most 366 rows
+    try:
+        start_date = datetime.date.fromisoformat(request.args['start-date'])
+        end_date = datetime.date.fromisoformat(request.args['end-date'])
+    except KeyError:
+        return {"msg": "Start date and end date needed."}, 400
+    except ValueError:
+        return {"msg": "Invalid date format."}, 400
+
+    if end_date < start_date or end_date - start_date > datetime.timedelta(days=366):
+        return {"msg": "Malformed dates."}, 400
+
+    select_statement = select(
+        ArrangementDayBucket.day,
+        func.sum(ArrangementDayBucket.departures).label('departures'),
+        func.sum(ArrangementDayBucket.free_seats).label('free_seats')
+    ).where(
+        ArrangementDayBucket.day >= start_date,
+        ArrangementDayBucket.day <= end_date,
+        ArrangementDayBucket.departures > 0
+    )
+
+    if (req_destination := request.args.get('dest', None)) is not None:
+        select_statement = select_statement.where(ArrangementDayBucket.destination == req_destination)
+
+    days = db.session.execute(
+        select_statement
+            .group_by(ArrangementDayBucket.day)
+            .order_by(ArrangementDayBucket.day.asc())
+    ).all()
+
+    return jsonify([
+        {"date": day.day.isoformat(), "departures": day.departures, "free_seats": day.free_seats} for day in days
+    ])
+
+
+@arrangements_bp.get('/destinations')
+def get_destination_completions():
+    # answered from the in-memory index, the search box calls this on every keystroke
+    prefix = request.args.get('prefix', '')
+    try:
+        limit = int(request.args.get('limit', 10))
+        if not 0 < limit <= current_app.config['AUTOCOMPLETE_MAX_RESULTS']:
+            raise ValueError
+    except ValueError:
+        return {"msg": "Invalid limit."}, 400
+
+    return jsonify(destinations.complete(prefix, limit))
+
+
+@arrangements_bp.get('')
+@jwt_required()
+def get_arrangements_by_ids():
+    try:
+        # duplicates are dropped, the first occurrence keeps its place
+        arrangement_ids = list(dict.fromkeys(int(arrangement_id) for arrangement_id in request.args['ids'].split(',')))
+    except (KeyError, ValueError):
+        return {"msg": "Arrangement ids needed."}, 400
+
+    if len(arrangement_ids) > current_app.config["MULTI_GET_MAX_IDS"]:
+        return {"msg": f"At most {current_app.config['MULTI_GET_MAX_IDS']} arrangements at once."}, 400
+
+    try:
+        fields = requested_fields(request.args, ARRANGEMENT_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    if fields is None:
+        columns = [*Arrangement.__table__.columns, Arrangement.seats_available]
     else:
-        sorting_param = sorts[req_sort_param]
-        raw_arrangements = db.session.execute(
-            select_statement
-                .order_by(sorting_param)
-                .limit(results_per_page)
-                .offset((page - 1) * results_per_page)
-        ).all()
+        # the id is always loaded, it puts the arrangements in the requested order
+        columns = projection(ARRANGEMENT_FIELDS, fields if "id" in fields else ("id", *fields))
+
+    found = {
+        arrangement.id: arrangement
+        for arrangement in db.session.execute(select(*columns).where(Arrangement.id.in_(arrangement_ids)))
+    }
 
-    return jsonify(schema.dump(raw_arrangements))
+    schema = sparse_schema(ArrangementSchema, fields)
+    return {
+        "arrangements": [schema.dump(found[arrangement_id])
+                         for arrangement_id in arrangement_ids if arrangement_id in found],
+        "missing": [arrangement_id for arrangement_id in arrangement_ids if arrangement_id not in found],
+    }
 
 
 @arrangements_bp.get('/<int:arrangement_id>')
 @jwt_required()
 def get_arrangement(arrangement_id):
-    arrangement = Arrangement.query.filter_by(id=arrangement_id).first_or_404(description='No such arrangement found.')
-    return arrangement_schema.dump(arrangement)
+    try:
+        fields = requested_fields(request.args, ARRANGEMENT_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    # during a flash sale every client asks for the same few arrangements, one query per worker answers them all;
+    # the whole row is cached, so every fieldset is cut from the same entry
+    arrangement = hot_reads.do(arrangement_key(arrangement_id), lambda: load_arrangement(arrangement_id))
+    if arrangement is None:
+        abort(404, description='No such arrangement found.')
+
+    if fields is not None:
+        return {field: arrangement[field] for field in fields}
+    return arrangement
+
+
+def arrangement_key(arrangement_id):
+    return f"arrangement:{arrangement_id}"
+
+
+def load_arrangement(arrangement_id):
+    arrangement = db.session.execute(
+        select(*Arrangement.__table__.columns, Arrangement.seats_available).where(Arrangement.id == arrangement_id)
+    ).first()
+
+    return arrangement_schema.dump(arrangement) if arrangement is not None else None
+
+
+def seat_events(arrangement_ids):
+    current_seats = db.session.execute(
+        select(Arrangement.id, Arrangement.seats_available).where(Arrangement.id.in_(arrangement_ids))
+    ).all()
+
+    # the stream can stay open for hours, it must not keep a database connection meanwhile
+    db.session.close()
+
+    keep_alive = current_app.config["SEAT_STREAM_KEEP_ALIVE"]
+    subscriber = seat_broker.subscribe(arrangement_ids)
+
+    def generate():
+        try:
+            for arrangement_id, seats_available in current_seats:
+                yield f"event: seats\ndata: {json.dumps({'arrangement_id': arrangement_id, 'seats_available': seats_available})}\n\n"
+
+            while True:
+                try:
+                    payload = subscriber.get(timeout=keep_alive)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield f"event: seats\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            seat_broker.unsubscribe(subscriber, arrangement_ids)
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@arrangements_bp.get('/<int:arrangement_id>/seats/stream')
+@jwt_required()
+def stream_arrangement_seats(arrangement_id):
+    Arrangement.query.filter_by(id=arrangement_id).first_or_404(description='No such arrangement found.')
+
+    return seat_events([arrangement_id])
+
+
+@arrangements_bp.get('/seats/stream')
+@jwt_required()
+def stream_seats():
+    try:
+        arrangement_ids = sorted({int(arrangement_id) for arrangement_id in request.args['ids'].split(',')})
+    except (KeyError, ValueError):
+        return {"msg": "Arrangement ids needed."}, 400
+
+    if len(arrangement_ids) > current_app.config["SEAT_STREAM_MAX_IDS"]:
+        return {"msg": "Too many arrangements."}, 400
+
+    return seat_events(arrangement_ids)
 
 
 @arrangements_bp.get('/own')
@@ -102,23 +317,37 @@ def get_arrangement(arrangement_id):
 def get_own_arrangements():
     user = get_current_user_custom()
 
-    if user.account_type.name == "ADMIN":
-        arrangements = Arrangement.query.filter_by(creator_id=user.id).all()
+    try:
+        fields = requested_fields(request.args, ARRANGEMENT_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    owner = Arrangement.creator_id if user.account_type.name == "ADMIN" else Arrangement.guide_id
+
+    if fields is None:
+        arrangements = Arrangement.query.filter(owner == user.id).all()
     else:
-        arrangements = Arrangement.query.filter_by(guide_id=user.id).all()
+        arrangements = db.session.execute(
+            select(*projection(ARRANGEMENT_FIELDS, fields)).where(owner == user.id)
+        ).all()
 
-    return jsonify(arrangements_schema.dump(arrangements))
+    return jsonify(sparse_schema(ArrangementSchema, fields, many=True).dump(arrangements))
 
 
 @arrangements_bp.post('/')
 @jwt_required()
 @roles_required("ADMIN")
+@idempotent
 def create_arrangement():
     try:
         arrangement = arrangement_schema.load(request.get_json())
         user = get_current_user_custom()
         arrangement.creator_id = user.id
         Arrangement.query.session.add(arrangement)
+        Arrangement.query.session.flush()
+        track_arrangement(arrangement)
+        destinations.track(arrangement)
+        record_arrangement_change(arrangement, "create")
         Arrangement.query.session.commit()
 
         return {
@@ -145,6 +374,10 @@ def update_arrangement(arrangement_id):
         try:
             request_arrangement = arrangement_schema.load(request.get_json())
 
+            # the calendar takes the arrangement out of its old day and back into the new one
+            track_arrangement(arrangement, -1)
+            destinations.track(arrangement, -1)
+
             # if we're assigning a guide
             if request_arrangement.guide_id is not None:
                 guide = User.query.filter_by(id=request_arrangement.guide_id).first_or_404(
@@ -161,6 +394,14 @@ def update_arrangement(arrangement_id):
                 # if we're not assigning a guide we just update the arrangement
                 arrangement.update(request_arrangement)
 
+            track_arrangement(arrangement)
+            destinations.track(arrangement)
+            record_arrangement_change(arrangement, "update")
+            # more seats may have been added
+            offers = promote_waitlist(arrangement)
+            seat_broker.seats_changed(arrangement.id)
+            hot_reads.changed(arrangement_key(arrangement.id))
+
             # either way we check if we're actually canceling the arrangement
             if request_arrangement.cancelled is True and arrangement_was_cancelled is False:
                 users = db.session.query(User) \
@@ -171,7 +412,10 @@ def update_arrangement(arrangement_id):
                 for user in users:
                     send_arrangement_cancelled_notification(user, arrangement)
 
+                drop_waitlist(arrangement.id)
+
             Arrangement.query.session.commit()
+            notify_offers(offers)
 
             return {
                 "msg": "Arrangement updated successfully.",
@@ -192,6 +436,8 @@ def update_arrangement(arrangement_id):
                 return {"msg": "Forbidden method."}, 403
 
             arrangement.description = description
+            record_arrangement_change(arrangement, "update")
+            hot_reads.changed(arrangement_key(arrangement.id))
             Arrangement.query.session.commit()
             return {"msg": "Successfully updated an description."}
 
@@ -215,6 +461,11 @@ def delete_arrangement(arrangement_id):
     for user in users:
         send_arrangement_cancelled_notification(user, arrangement)
 
+    track_arrangement(arrangement, -1)
+    destinations.track(arrangement, -1)
+    record_arrangement_change(arrangement, "delete")
+    hot_reads.changed(arrangement_key(arrangement.id))
+    drop_waitlist(arrangement.id)
     Arrangement.query.session.delete(arrangement)
     Arrangement.query.session.commit()
 
@@ -227,31 +478,7 @@ def delete_arrangement(arrangement_id):
 def get_available_arrangements():
     current_user = get_current_user_custom()
 
-    with db.engine.connect() as connection:
-        # slower
-        # query_text = text(
-        #     'SELECT * FROM arrangement '
-        #     'WHERE arrangement.start_date > CURRENT_DATE + 5 AND ('
-        #     'SELECT COUNT(*) FROM reservation '
-        #     'WHERE reservation.arrangement_id = arrangement.id AND reservation.customer_id = :curr_user_id'
-        #     ') = 0;')
-
-        # faster query
-        # select all the arrangement with appropriate date which are not already reserved by the current user
-        query_text = text(
-            'SELECT * FROM arrangement '
-            'WHERE '
-                'arrangement.start_date > CURRENT_DATE + 5 '
-            'AND '
-                'arrangement.id not in ('
-                    'SELECT arrangement_id FROM reservation '
-                    'WHERE '
-                        'reservation.arrangement_id = arrangement.id '
-                    'AND '
-                        'reservation.customer_id = :curr_user_id'
-                ');'
-        )
-
-        available_arrangements = connection.execute(query_text, curr_user_id=current_user.id)
-
-        return jsonify([arrangement_schema.dump(arrangement) for arrangement in available_arrangements])
+    # executed through the session so it is routed to a replica like the other reads
+    available_arrangements = db.session.execute(AVAILABLE_ARRANGEMENTS_QUERY, {"curr_user_id": current_user.id})
+
+    return jsonify([arrangement_schema.dump(arrangement) for arrangement in available_arrangements])
@@ -7,6 +7,8 @@ from flask_jwt_extended import verify_jwt_in_request, create_access_token, creat
     get_jwt_identity
 from werkzeug.security import check_password_hash
 
+from config.extensions import limiter
+from utils.concurrency import priority
 from models.models import User
 from schemas.schemas_rest import user_schema
 
@@ -39,6 +41,30 @@ def login_required():
     return wrapper
 
 
+def rate_limited(scope, *identity_fields):
+    # checked before the handler runs, so throttled calls never reach the password hashing,
+    # the database or the mail server; every call is counted against the client address
+    # and against each of the given request fields (e.g. username, email)
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            json_req = request.get_json(silent=True) or {}
+            keys = [f"ip:{request.remote_addr}"]
+            keys.extend(
+                f"{field}:{str(json_req[field]).lower()}" for field in identity_fields if json_req.get(field)
+            )
+
+            retry_after = limiter.hit(scope, keys)
+            if retry_after:
+                return {"msg": "Too many requests."}, 429, {"Retry-After": str(retry_after)}
+
+            return fn(*args, **kwargs)
+
+        return decorator
+
+    return wrapper
+
+
 def get_current_user_custom():
     jwt_user = flask_jwt_extended.get_jwt_identity()
     return user_schema.get_user_from_jwt_claims(jwt_user)
@@ -48,6 +74,8 @@ auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 
 @auth_bp.post('/login')
+@priority("critical")
+@rate_limited("login", "username")
 def login():
     json_req = request.get_json()
     username = json_req.get("username", None)
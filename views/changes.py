@@ -0,0 +1,36 @@
+from flask import request, current_app, Blueprint
+from flask_jwt_extended import verify_jwt_in_request
+
+from utils.change_feed import read_changes
+from views.auth import get_current_user_custom
+
+changes_bp = Blueprint('changes', __name__, url_prefix='/changes')
+
+
+@changes_bp.get('')
+def get_changes():
+    # everyone can follow the catalogue, in full when logged in, only admins get the reservations too
+    detailed = verify_jwt_in_request(optional=True) is not None
+    if detailed and get_current_user_custom().account_type.name == "ADMIN":
+        entities = ("arrangement", "reservation")
+    else:
+        entities = ("arrangement",)
+
+    try:
+        limit = min(int(request.args.get('limit', current_app.config['CHANGES_PER_BATCH'])),
+                    current_app.config['CHANGES_PER_BATCH'])
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        return {"msg": "Invalid limit."}, 400
+
+    try:
+        changes, cursor, has_more = read_changes(request.args.get('since', '0-0'), limit, entities, detailed)
+    except ValueError:
+        return {"msg": "Invalid cursor."}, 400
+
+    return {
+        "changes": changes,
+        "cursor": cursor,
+        "has_more": has_more,
+    }
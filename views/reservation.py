@@ -2,14 +2,25 @@ import datetime
 
 import marshmallow
 import sqlalchemy.exc
-from flask import current_app, jsonify, request, Blueprint
+from flask import jsonify, request, Blueprint, current_app
 from flask_jwt_extended import jwt_required
+from sqlalchemy import select
 
 from views.auth import roles_required, get_current_user_custom
-from config.extensions import db
+from views.arrangement import arrangement_key
+from config.extensions import db, seat_broker, hot_reads
 from utils.mail_service import send_successful_reservation_notification, send_reservation_cancelled_notification
-from models.models import Reservation, Arrangement, User
-from schemas.schemas_rest import reservations_schema, reservation_schema, completed_reservation_schema
+from utils.calendar import track_seats
+from utils.change_feed import record_reservation_change
+from utils.concurrency import priority
+from utils.fieldsets import requested_fields, projection, sparse_schema
+from utils.idempotency import idempotent
+from utils.pagination import paginated_response
+from utils.replica import primary_read
+from utils.waitlist import promote_waitlist, leave_waitlist, notify_offers
+from models.models import Reservation, Arrangement, User, SeatHold, WaitlistEntry
+from schemas.schemas_rest import reservation_schema, completed_reservation_schema, ReservationSchema, \
+    RESERVATION_FIELDS, seat_hold_schema, waitlist_entry_schema, waitlist_entries_schema
 
 reservation_bp = Blueprint('reservations', __name__, url_prefix='/reservations')
 
@@ -21,28 +32,51 @@ def get_all_reservations(page_id=1):
     if page_id <= 0:
         return {"msg", "Invalid page id."}, 400
 
-    raw_reservations = db.session.execute(
-        Reservation.query
-            .limit(current_app.config['RESULTS_PER_PAGE'])
-            .offset((page_id - 1) * current_app.config['RESULTS_PER_PAGE'])
-    ).all()
+    try:
+        fields = requested_fields(request.args, RESERVATION_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    # ordered by the primary key so the pages are stable
+    order = (Reservation.arrangement_id.asc(), Reservation.customer_id.asc())
+
+    if fields is None:
+        return paginated_response(select(Reservation).order_by(*order), page_id, request.args,
+                                  lambda raw_reservations: [reservation_schema.dump(reservation[0])
+                                                            for reservation in raw_reservations])
 
-    return jsonify([reservation_schema.dump(reservation[0]) for reservation in raw_reservations])
+    select_statement = select(*projection(RESERVATION_FIELDS, fields)).order_by(*order)
+    return paginated_response(select_statement, page_id, request.args,
+                              sparse_schema(ReservationSchema, fields, many=True).dump)
 
 
 @reservation_bp.get('/own')
 @jwt_required()
 @roles_required("TOURIST")
+@primary_read
 def get_own_reservations():
     current_user = get_current_user_custom()
-    reservations = Reservation.query.filter_by(customer_id=current_user.id).all()
 
-    return jsonify(reservations_schema.dump(reservations))
+    try:
+        fields = requested_fields(request.args, RESERVATION_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    if fields is None:
+        reservations = Reservation.query.filter_by(customer_id=current_user.id).all()
+    else:
+        reservations = db.session.execute(
+            select(*projection(RESERVATION_FIELDS, fields)).where(Reservation.customer_id == current_user.id)
+        ).all()
+
+    return jsonify(sparse_schema(ReservationSchema, fields, many=True).dump(reservations))
 
 
 @reservation_bp.post('')
+@priority("critical")
 @jwt_required()
 @roles_required("ADMIN", "TOURIST")
+@idempotent
 def create_reservation():
     try:
         user = get_current_user_custom()
@@ -56,15 +90,24 @@ def create_reservation():
             reservation = reservation_schema.load(request.get_json())
             reservation.customer_id = req_customer_id
 
-        wanted_arrangement = Arrangement.query.filter_by(id=reservation.arrangement_id).first_or_404(
-            description="No such arrangement found.")
+        # locked until the commit, so concurrent reservations and holds can't take the same last seats
+        wanted_arrangement = Arrangement.query.filter_by(id=reservation.arrangement_id) \
+            .with_for_update(key_share=True) \
+            .first_or_404(description="No such arrangement found.")
 
-        if wanted_arrangement.start_date - datetime.date.today() <= datetime.timedelta(days=5):
+        if wanted_arrangement.cancelled:
+            return {"msg": "Wanted arrangement is cancelled."}, 404
+        elif wanted_arrangement.start_date - datetime.date.today() <= datetime.timedelta(days=5):
             return {"msg": "Wanted arrangement has expired."}, 404
         elif wanted_arrangement.seats_available < reservation.seats_needed:
             return {"msg": "There is not that much seats left."}, 404
 
         Reservation.query.session.add(reservation)
+        leave_waitlist(reservation.arrangement_id, reservation.customer_id)
+        track_seats(wanted_arrangement, -reservation.seats_needed)
+        record_reservation_change(reservation, "create")
+        seat_broker.seats_changed(reservation.arrangement_id)
+        hot_reads.changed(arrangement_key(reservation.arrangement_id))
         Reservation.query.session.commit()
 
         send_successful_reservation_notification(user, reservation, wanted_arrangement)
@@ -85,6 +128,7 @@ def create_reservation():
 
 
 @reservation_bp.delete('/<int:arrangement_id>')
+@priority("critical")
 @jwt_required()
 @roles_required("ADMIN", "TOURIST")
 def delete_reservation(arrangement_id):
@@ -96,8 +140,17 @@ def delete_reservation(arrangement_id):
         reservation = Reservation.query.filter_by(arrangement_id=arrangement_id) \
             .first_or_404(description="No such reservation found.")
 
+    # the arrangement is locked before its reservations and holds are written, like in the other seat writes
+    arrangement = Arrangement.query.filter_by(id=reservation.arrangement_id).with_for_update(key_share=True).first()
+
+    track_seats(arrangement, reservation.seats_needed)
+    record_reservation_change(reservation, "delete")
     Reservation.query.session.delete(reservation)
+    offers = promote_waitlist(arrangement)
+    seat_broker.seats_changed(reservation.arrangement_id)
+    hot_reads.changed(arrangement_key(reservation.arrangement_id))
     Reservation.query.session.commit()
+    notify_offers(offers)
 
     if user.account_type.name == "TOURIST":
         send_reservation_cancelled_notification(user, reservation)
@@ -110,6 +163,7 @@ def delete_reservation(arrangement_id):
 
 
 @reservation_bp.put('/<int:arrangement_id>')
+@priority("critical")
 @jwt_required()
 @roles_required("ADMIN", "TOURIST")
 def update_reservation(arrangement_id):
@@ -130,12 +184,19 @@ def update_reservation(arrangement_id):
 
         req_seats_needed = request.get_json()['seats_needed']
 
-        arrangement = Arrangement.query.filter_by(id=reservation.arrangement_id) \
+        arrangement = Arrangement.query.filter_by(id=reservation.arrangement_id).with_for_update(key_share=True) \
             .first_or_404(description="No such arrangement exists.")
 
-        if arrangement.seats_available >= req_seats_needed:
+        # the reservation's own seats are given back before the new count is taken
+        if arrangement.seats_available + reservation.seats_needed >= req_seats_needed:
+            track_seats(arrangement, reservation.seats_needed - req_seats_needed)
             reservation.seats_needed = req_seats_needed
+            record_reservation_change(reservation, "update")
+            offers = promote_waitlist(arrangement)
+            seat_broker.seats_changed(reservation.arrangement_id)
+            hot_reads.changed(arrangement_key(reservation.arrangement_id))
             Reservation.query.session.commit()
+            notify_offers(offers)
 
             send_successful_reservation_notification(user, reservation, arrangement, True)
 
@@ -143,10 +204,199 @@ def update_reservation(arrangement_id):
                     "reservation": completed_reservation_schema.dump(reservation)}
 
         return {"msg": "There is not enough seats needed. Reservation unchanged.",
-                "reservation": completed_reservation_schema(reservation)}
+                "reservation": completed_reservation_schema.dump(reservation)}
 
     except KeyError:
         return {"msg": "Seats needed field is  missing."}, 400
 
     except TypeError:
         return {"msg": "Malformed request."}, 400
+
+
+@reservation_bp.post('/holds')
+@priority("critical")
+@jwt_required()
+@roles_required("TOURIST")
+def create_seat_hold():
+    user = get_current_user_custom()
+
+    try:
+        requested_hold = seat_hold_schema.load(request.get_json())
+    except marshmallow.ValidationError as err:
+        return err.messages, 400
+
+    # locked until the commit, so concurrent reservations and holds can't take the same last seats
+    arrangement = Arrangement.query.filter_by(id=requested_hold.arrangement_id).with_for_update(key_share=True) \
+        .first_or_404(description="No such arrangement found.")
+
+    if arrangement.cancelled:
+        return {"msg": "Wanted arrangement is cancelled."}, 404
+    elif arrangement.start_date - datetime.date.today() <= datetime.timedelta(days=5):
+        return {"msg": "Wanted arrangement has expired."}, 404
+
+    if Reservation.query.filter_by(arrangement_id=arrangement.id, customer_id=user.id).first() is not None:
+        return {"msg": "Already made such a reservation."}, 403
+
+    now = datetime.datetime.now()
+    seats_available = db.session.execute(
+        select(Arrangement.seats_available).where(Arrangement.id == arrangement.id)
+    ).scalar()
+
+    # holding again replaces the customer's previous hold on the arrangement and restarts its time
+    hold = SeatHold.query.filter_by(arrangement_id=arrangement.id, customer_id=user.id).first()
+    if hold is not None and hold.expires_at > now:
+        seats_available += hold.seats_needed
+
+    if seats_available < requested_hold.seats_needed:
+        return {"msg": "There is not that much seats left."}, 404
+
+    # the calendar counts a hold's seats until the hold is deleted, expired or not
+    if hold is None:
+        hold = requested_hold
+        hold.customer_id = user.id
+        SeatHold.query.session.add(hold)
+        track_seats(arrangement, -hold.seats_needed)
+    else:
+        track_seats(arrangement, hold.seats_needed - requested_hold.seats_needed)
+        hold.seats_needed = requested_hold.seats_needed
+
+    hold.expires_at = now + current_app.config["SEAT_HOLD_TTL"]
+    leave_waitlist(arrangement.id, user.id)
+    seat_broker.seats_changed(arrangement.id)
+    hot_reads.changed(arrangement_key(arrangement.id))
+    SeatHold.query.session.commit()
+
+    return {"msg": "Successfully held the seats.", "hold": seat_hold_schema.dump(hold)}
+
+
+@reservation_bp.post('/holds/<int:arrangement_id>/confirm')
+@priority("critical")
+@jwt_required()
+@roles_required("TOURIST")
+@idempotent
+def confirm_seat_hold(arrangement_id):
+    user = get_current_user_custom()
+
+    # the arrangement is locked before the hold, like in the other seat writes, so the sweeper,
+    # which skips locked arrangements, can't release the hold while it becomes the reservation
+    arrangement = Arrangement.query.filter_by(id=arrangement_id).with_for_update(key_share=True) \
+        .first_or_404(description="No such hold found, or it has expired.")
+    hold = SeatHold.query \
+        .filter(SeatHold.arrangement_id == arrangement_id, SeatHold.customer_id == user.id,
+                SeatHold.expires_at > datetime.datetime.now()) \
+        .with_for_update() \
+        .first_or_404(description="No such hold found, or it has expired.")
+
+    if arrangement.cancelled:
+        return {"msg": "Wanted arrangement is cancelled."}, 404
+
+    try:
+        # the held seats just become reserved ones, the availability stays the same
+        reservation = Reservation(arrangement_id=hold.arrangement_id, customer_id=user.id,
+                                  seats_needed=hold.seats_needed)
+        Reservation.query.session.add(reservation)
+        SeatHold.query.session.delete(hold)
+        record_reservation_change(reservation, "create")
+        Reservation.query.session.commit()
+
+    except sqlalchemy.exc.IntegrityError:
+        return {"msg": "Already made such a reservation."}, 403
+
+    send_successful_reservation_notification(user, reservation, arrangement)
+
+    return {
+               "msg": "Successfully appointed a reservation",
+               "reservation": completed_reservation_schema.dump(reservation)
+           }, 200
+
+
+@reservation_bp.delete('/holds/<int:arrangement_id>')
+@priority("critical")
+@jwt_required()
+@roles_required("TOURIST")
+def delete_seat_hold(arrangement_id):
+    user = get_current_user_custom()
+
+    arrangement = Arrangement.query.filter_by(id=arrangement_id).with_for_update(key_share=True) \
+        .first_or_404(description="No such hold found.")
+    hold = SeatHold.query.filter_by(arrangement_id=arrangement_id, customer_id=user.id).with_for_update() \
+        .first_or_404(description="No such hold found.")
+
+    track_seats(arrangement, hold.seats_needed)
+    SeatHold.query.session.delete(hold)
+    offers = promote_waitlist(arrangement)
+    seat_broker.seats_changed(arrangement_id)
+    hot_reads.changed(arrangement_key(arrangement_id))
+    SeatHold.query.session.commit()
+    notify_offers(offers)
+
+    return {"msg": "Successfully released the held seats."}
+
+
+@reservation_bp.get('/waitlist/own')
+@jwt_required()
+@roles_required("TOURIST")
+@primary_read
+def get_own_waitlist_entries():
+    current_user = get_current_user_custom()
+
+    entries = WaitlistEntry.query.filter_by(customer_id=current_user.id).all()
+
+    return jsonify(waitlist_entries_schema.dump(entries))
+
+
+@reservation_bp.post('/waitlist')
+@jwt_required()
+@roles_required("TOURIST")
+def join_waitlist():
+    user = get_current_user_custom()
+
+    try:
+        entry = waitlist_entry_schema.load(request.get_json())
+    except marshmallow.ValidationError as err:
+        return err.messages, 400
+
+    # locked so a promotion can't run between the seats check and the tourist joining the queue
+    arrangement = Arrangement.query.filter_by(id=entry.arrangement_id).with_for_update(key_share=True) \
+        .first_or_404(description="No such arrangement found.")
+
+    if arrangement.start_date - datetime.date.today() <= datetime.timedelta(days=5):
+        return {"msg": "Wanted arrangement has expired."}, 404
+
+    if Reservation.query.filter_by(arrangement_id=arrangement.id, customer_id=user.id).first() is not None:
+        return {"msg": "Already made such a reservation."}, 403
+
+    if SeatHold.query.filter(SeatHold.arrangement_id == arrangement.id, SeatHold.customer_id == user.id,
+                             SeatHold.expires_at > datetime.datetime.now()).first() is not None:
+        return {"msg": "Seats are already held for you."}, 403
+
+    seats_available = db.session.execute(
+        select(Arrangement.seats_available).where(Arrangement.id == arrangement.id)
+    ).scalar()
+    if seats_available >= entry.seats_needed:
+        return {"msg": "There are enough seats left, no need to wait for them."}, 409
+
+    try:
+        entry.customer_id = user.id
+        WaitlistEntry.query.session.add(entry)
+        WaitlistEntry.query.session.commit()
+
+    except sqlalchemy.exc.IntegrityError:
+        return {"msg": "Already waiting for this arrangement."}, 403
+
+    return {"msg": "Successfully joined the waitlist.", "entry": waitlist_entry_schema.dump(entry)}
+
+
+@reservation_bp.delete('/waitlist/<int:arrangement_id>')
+@jwt_required()
+@roles_required("TOURIST")
+def leave_arrangement_waitlist(arrangement_id):
+    user = get_current_user_custom()
+
+    entry = WaitlistEntry.query.filter_by(arrangement_id=arrangement_id, customer_id=user.id) \
+        .first_or_404(description="No such waitlist entry found.")
+
+    WaitlistEntry.query.session.delete(entry)
+    WaitlistEntry.query.session.commit()
+
+    return {"msg": "Successfully left the waitlist."}
@@ -1,4 +1,5 @@
 import datetime
+from functools import lru_cache
 from time import time
 
 import jwt
@@ -6,22 +7,53 @@ import marshmallow
 import sqlalchemy.exc
 from flask import current_app, request, jsonify, Blueprint
 from flask_jwt_extended import jwt_required
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, select, bindparam
 from werkzeug.security import generate_password_hash
 
-from views.auth import roles_required, get_current_user_custom
+from views.auth import roles_required, get_current_user_custom, rate_limited
 from views.auth import auth_bp
-from config.extensions import db
+from config.extensions import db, account_types
+from utils.concurrency import priority
 from utils.mail_service import send_successful_registration, send_password_reset_email, send_password_changed_email
-from models.models import User, AccountType, AccountTypeChangeRequest, Arrangement
+from utils.fieldsets import requested_fields, projection, sparse_schema
+from utils.pagination import paginated_response, Listing
+from utils.replica import primary_read
+from models.models import User, AccountType, AccountTypeChangeRequest, Arrangement, user_type_table
 from schemas.schemas_rest import users_schema, type_schema, types_schema, user_schema, guide_arrangement_schema, \
-    tourist_reservation_schema
+    tourist_reservation_schema, UserSchema, USER_FIELDS
 
 types_bp = Blueprint('types', __name__, url_prefix='/types')
 users_bp = Blueprint('users', __name__, url_prefix='/users')
 users_bp.register_blueprint(types_bp)
 
 
+USER_SORTS = {
+    "id-a": User.id.asc(),
+    "id-d": User.id.desc(),
+    "email-a": User.email.asc(),
+    "email-d": User.email.desc(),
+    "username-a": User.username.asc(),
+    "username-d": User.username.desc(),
+    "first-name-a": User.first_name.asc(),
+    "first-name-d": User.first_name.desc(),
+    "last-name-a": User.last_name.asc(),
+    "last-name-d": User.last_name.desc(),
+}
+
+
+@lru_cache(maxsize=256)
+def users_template(fields, by_type, sort):
+    # one prebuilt listing per shape of the listing request, the account type is bound per request
+    select_statement = select(User) if fields is None else select(*projection(USER_FIELDS, fields))
+
+    if by_type:
+        select_statement = select_statement \
+            .join(user_type_table, user_type_table.c.user_id == User.id) \
+            .filter(user_type_table.c.account_type_id == bindparam("account_type_id"))
+
+    return Listing(select_statement.order_by(USER_SORTS[sort]))
+
+
 @users_bp.get('/page/<int:page>')
 @jwt_required()
 @roles_required("ADMIN")
@@ -29,52 +61,44 @@ def get_all_users(page=1):
     if page <= 0:
         return {"msg": "Invalid page number."}, 400
 
-    results_per_page = current_app.config.get('RESULTS_PER_PAGE')
-    sorts = {
-        "id-a": User.id.asc(),
-        "id-d": User.id.desc(),
-        "email-a": User.email.asc(),
-        "email-d": User.email.desc(),
-        "username-a": User.username.asc(),
-        "username-d": User.username.desc(),
-        "first-name-a": User.first_name.asc(),
-        "first-name-d": User.first_name.desc(),
-        "last-name-a": User.last_name.asc(),
-        "last-name-d": User.last_name.desc(),
-    }
-
+    # users are ordered by id if there's no sorting parameter or it doesn't exist
     req_sort_param = request.args.get('sort', None)
+    if req_sort_param not in USER_SORTS:
+        req_sort_param = "id-a"
+
+    try:
+        fields = requested_fields(request.args, USER_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
 
+    params = {}
     if (requested_type := request.args.get('type', None)) and requested_type is not None:
-        requested_type_id = AccountType.query.filter_by(name=requested_type).first_or_404(
-            description="No such role.").id
-        select_statement = User.query.join(User.account_type).filter_by(id=requested_type_id)
-    else:
-        select_statement = User.query
-
-    if req_sort_param is None or sorts.get(req_sort_param, None) is None:
-        raw_users = db.session.execute(
-            select_statement
-                .order_by(User.id.asc())
-                .limit(results_per_page)
-                .offset((page - 1) * results_per_page)
-        ).all()
-    else:
-        sorting_param = sorts[req_sort_param]
-        raw_users = db.session.execute(
-            select_statement
-                .order_by(sorting_param)
-                .limit(results_per_page)
-                .offset((page - 1) * results_per_page)
-        ).all()
+        params["account_type_id"] = account_types.get_or_404(name=requested_type, description="No such role.").id
+
+    select_statement = users_template(fields, "account_type_id" in params, req_sort_param)
+
+    if fields is None:
+        return paginated_response(select_statement, page, request.args,
+                                  lambda raw_users: [user_schema.dump(user[0]) for user in raw_users], params)
 
-    return jsonify([user_schema.dump(user[0]) for user in raw_users])
+    return paginated_response(select_statement, page, request.args, sparse_schema(UserSchema, fields, many=True).dump,
+                              params)
 
 
 @users_bp.get('/<int:user_id>')
 @jwt_required()
 @roles_required("ADMIN")
 def get_user(user_id):
+    try:
+        fields = requested_fields(request.args, USER_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    if fields is not None:
+        user = User.query.with_entities(*projection(USER_FIELDS, fields)).filter_by(id=user_id) \
+            .first_or_404(description="No such user.")
+        return sparse_schema(UserSchema, fields).dump(user)
+
     user = User.query.filter_by(id=user_id).first_or_404(description="No such user.")
 
     for acc_type in user.account_type:
@@ -87,6 +111,8 @@ def get_user(user_id):
 
 
 @auth_bp.post('/register')
+@priority("critical")
+@rate_limited("register", "username", "email")
 def register_user():
     try:
         wanted_type = None
@@ -95,8 +121,7 @@ def register_user():
 
         user = user_schema.load(request.get_json())
 
-        tourist_acc_type = AccountType.query.filter_by(name="TOURIST").first_or_404(description="Role does not exist.")
-        user.account_type.append(tourist_acc_type)
+        user.account_type.append(account_types.attach_or_404("TOURIST", description="Role does not exist."))
         user.password = generate_password_hash(
             user.password,
             current_app.config.get("PASSWORD_HASH_ALGORITHM"),
@@ -106,8 +131,7 @@ def register_user():
         User.query.session.add(user)
 
         if wanted_type is not None:
-            acc_type = AccountType.query.filter_by(name=wanted_type) \
-                .first_or_404(description="No such account type found.")
+            acc_type = account_types.get_or_404(name=wanted_type)
 
             change_request = AccountTypeChangeRequest(
                 user_id=user.id,
@@ -134,6 +158,7 @@ def register_user():
 
 
 @auth_bp.post('/forgot-password')
+@rate_limited("forgot-password", "email")
 def get_reset_token():
     try:
         email = request.get_json().get('email', None)
@@ -228,7 +253,7 @@ def delete_user(user_id):
 @roles_required("ADMIN")
 def get_free_guides():
     try:
-        guide = AccountType.query.filter_by(name="GUIDE").first()
+        guide_type_id = account_types.id_of("GUIDE")
         req_start_date = request.args.get('start_date')
         req_end_date = request.args.get('end_date')
 
@@ -241,7 +266,7 @@ def get_free_guides():
         users = db.session.query(User) \
             .outerjoin(Arrangement, Arrangement.guide_id == User.id) \
             .where(
-            User.account_type.any(id=guide.id),
+            User.account_type.any(id=guide_type_id),
             or_(
                 and_(end_date <= Arrangement.start_date, start_date >= Arrangement.end_date),
                 Arrangement.id == None,
@@ -256,11 +281,21 @@ def get_free_guides():
 
 @users_bp.get('/self')
 @jwt_required()
+@primary_read
 def get_own_user():
     req_user = get_current_user_custom()
-    user = User.query.filter_by(id=req_user.id).first()
 
-    return user_schema.dump(user)
+    try:
+        fields = requested_fields(request.args, USER_FIELDS)
+    except ValueError as error:
+        return {"msg": str(error)}, 400
+
+    if fields is None:
+        user = User.query.filter_by(id=req_user.id).first()
+    else:
+        user = User.query.with_entities(*projection(USER_FIELDS, fields)).filter_by(id=req_user.id).first()
+
+    return sparse_schema(UserSchema, fields).dump(user)
 
 
 @users_bp.put('/self')
@@ -326,6 +361,7 @@ def create_type():
         acc_type = type_schema.load(request.get_json())
 
         AccountType.query.session.add(acc_type)
+        account_types.changed()
         AccountType.query.session.commit()
 
         return {
@@ -344,6 +380,7 @@ def delete_type(type_id):
     acc_type = AccountType.query.filter_by(id=type_id).first_or_404(description="No such type.")
 
     AccountType.query.session.delete(acc_type)
+    account_types.changed()
     AccountType.query.session.commit()
 
     return {"msg": "Successfully deleted a type."}
@@ -357,6 +394,7 @@ def update_type(type_id):
         acc_type = AccountType.query.filter_by(id=type_id).first_or_404(description="No such type.")
         req_name = request.get_json()['name']
         acc_type.name = req_name
+        account_types.changed()
         AccountType.query.session.commit()
 
         return {